@@ -1,3 +1,7 @@
+import multiprocessing
+import operator
+from multiprocessing import shared_memory
+
 import numpy as np
 
 
@@ -16,31 +20,127 @@ class Node:
 
 
 class Leaf:
-    def __init__(self, d, x):
+    def __init__(self, d, x, counts=None):
         """
         Leaf node initialisation.
 
         :param d: Decision tree object
         :param x: Prediction
+        :param counts: The label counts of the leaf, counted from x if None.
         """
-        self.pred = DecisionTree.classcount(d, x)
+        if counts is None:
+            counts = DecisionTree.classcount(d, x)
+        self.pred = counts
+
+
+def treecomparison(maxbins=None):
+    """
+    A function to get the test of the nodes of compiled trees, which send an example to their left child when the
+    feature of the example equals their value, or is below it for binned features.
+
+    :param maxbins: The number of quantile bins of the trees, None for trees on the features themselves.
+    :return: The comparison of the features to the values, elementwise on arrays.
+    """
+    return operator.eq if maxbins is None else operator.lt
+
+
+def walklazy(getfeature, node, feature, value, left, right, compare):
+    """
+    A function to get the leaf a single example ends up in on compiled tree arrays, asking for its features only
+    at the nodes of its path.
+
+    :param getfeature: A function of a column returning the feature of the example in that column.
+    :param node: The position of the root of the tree in the arrays.
+    :param feature: The column each node tests, -1 for a leaf.
+    :param value: The value each node compares the feature to.
+    :param left: The child of each node for the examples passing its test.
+    :param right: The child of each node for the other examples.
+    :param compare: The test of the nodes, such as the one of treecomparison.
+    :return: The position of the leaf in the arrays.
+    """
+    while feature[node] >= 0:
+        node = left[node] if compare(getfeature(int(feature[node])), value[node]) else right[node]
+    return node
+
+
+def walktrees(X, roots, feature, value, left, right, compare):
+    """
+    A function to get the leaf many examples end up in on each of several trees stacked into compiled arrays.
+    Every tree is evaluated on every example together, all of them moving down one level of their tree at a time.
+
+    :param X: The test examples, one per row.
+    :param roots: The position of the root of each tree in the arrays.
+    :param feature: The column each node tests, -1 for a leaf.
+    :param value: The value each node compares the feature to.
+    :param left: The child of each node for the examples passing its test.
+    :param right: The child of each node for the other examples.
+    :param compare: The test of the nodes, such as the one of treecomparison.
+    :return: The position of the leaf of each tree and example in the arrays, one row per tree.
+    """
+    node = np.repeat(np.asarray(roots, dtype=np.int64)[:, None], len(X), axis=1)
+    active = feature[node] >= 0
+    while active.any():
+        tree, row = np.nonzero(active)
+        current = node[tree, row]
+        match = compare(X[row, feature[current]], value[current])
+        node[tree, row] = np.where(match, left[current], right[current])
+        active[tree, row] = feature[node[tree, row]] >= 0
+    return node
+
+
+def stacktrees(trees):
+    """
+    A function to stack the compiled arrays of several trees into a single set of arrays, the children indices of
+    each tree being shifted by the position of its root.
+
+    :param trees: The arrays of each tree, as tuples of the feature, left and right arrays followed by any other
+        arrays of the nodes.
+    :return: The position of the root of each tree, then the stacked arrays in the order of the tuples.
+    """
+    roots, stacked = [], [[] for _ in trees[0]]
+    offset = 0
+    for tree in trees:
+        roots.append(offset)
+        feature, left, right = tree[:3]
+        for arrays, array in zip(stacked, (feature, np.where(left >= 0, left + offset, -1),
+                                           np.where(right >= 0, right + offset, -1)) + tuple(tree[3:])):
+            arrays.append(array)
+        offset += len(feature)
+    return (np.asarray(roots, dtype=np.int64),) + tuple(np.concatenate(arrays) for arrays in stacked)
 
 
 class DecisionTree:
-    def __init__(self, X_train, y, maxdepth=5):
+    def __init__(self, X_train=None, y=None, maxdepth=5, maxbins=None, blocksize=None):
         """
         Decision tree object intialisation.
 
-        :param X_train: Dataset used for training
+        :param X_train: Dataset used for training, None for a tree grown on other rows or rebuilt from its arrays.
         :param y: The target value for the training dateset.
         :param maxdepth: The maximum depth of the decision tree
+        :param maxbins: The number of quantile bins of each feature to pick the thresholds of the nodes from, if the
+            features are real valued. The nodes test for equality with a feature value if None.
+        :param blocksize: The number of rows read at a time when building the tree, for a training dataset on disk
+            such as a np.memmap. The whole training dataset is used at once if None.
         """
-        self.X_train = X_train[:, -1]
+        if X_train is None:
+            self.X_train = None
+        else:
+            self.X_train = X_train.column(-1) if isinstance(X_train, BitMatrix) else X_train[:, -1]
         self.y = y
         self.totaldutch = 0
         self.totalenglish = 0
         self.maxdepth = maxdepth
+        self.maxbins = maxbins
+        self.blocksize = blocksize
         self.dt = None
+        self.extractor = None
+        self.feature = None
+        self.value = None
+        self.left = None
+        self.right = None
+        self.leafclass = None
+        self.leafcounts = None
+        self.lookup = None
         # self.data = np.column_stack((self.X_train, self.y))
 
     def rootnode(self, dt):
@@ -50,42 +150,310 @@ class DecisionTree:
         :param dt: The root node
         """
         self.dt = dt
+        self.compile_tree()
+
+    def compile_tree(self):
+        """
+        A function to flatten the decision tree into arrays for batch inference. Node i tests whether the feature
+        feature[i] equals value[i] and goes to left[i] if it does and to right[i] otherwise, leaves have a feature
+        of -1 and predict leafclass[i].
+        """
+        nodes = [self.dt]
+        for node in nodes:
+            if isinstance(node, Node):
+                nodes += [node.englishbranch, node.dutchbranch]
+        position = {id(node): i for i, node in enumerate(nodes)}
+        nclasses = 1 + max(int(k) for node in nodes if isinstance(node, Leaf) for k in node.pred)
+
+        self.feature = np.full(len(nodes), -1, dtype=np.int64)
+        self.value = np.zeros(len(nodes), dtype=np.int64 if self.maxbins is None else np.float64)
+        self.left = np.full(len(nodes), -1, dtype=np.int64)
+        self.right = np.full(len(nodes), -1, dtype=np.int64)
+        self.leafclass = np.full(len(nodes), -1, dtype=np.int64)
+        self.leafcounts = np.zeros((len(nodes), nclasses), dtype=np.float64)
+        for i, node in enumerate(nodes):
+            if isinstance(node, Leaf):
+                self.leafclass[i] = self.predictlabel(node.pred)
+                for k in node.pred:
+                    self.leafcounts[i, int(k)] = node.pred[k]
+            else:
+                self.feature[i] = node.question.col
+                self.value[i] = node.question.val
+                self.left[i] = position[id(node.englishbranch)]
+                self.right[i] = position[id(node.dutchbranch)]
 
-    def build_tree(self, x, depth=5):
+    def predict_batch(self, X):
         """
-        A function to build the tree based on the training set.
+        A function to classify many examples at once on the compiled tree. All the examples move down one level
+        of the tree at a time.
+
+        :param X: The test examples, one per row.
+        :return: The predicted label of each example.
+        """
+        return self.leafclass[self.leafindex(X)]
+
+    def predict_lazy(self, feature):
+        """
+        A function to classify a single example on the compiled tree, asking for its features only at the nodes of
+        its path.
+
+        :param feature: A function of a column returning the feature of the example in that column, such as the
+            one FeatureExtractor.lazyfeatures gives.
+        :return: The predicted label of the example.
+        """
+        return self.leafclass[self.lazyleaf(feature)]
+
+    def lazyleaf(self, feature, node=0):
+        """
+        A function to get the leaf a single example ends up in on the compiled tree, asking for its features only
+        at the nodes of its path.
+
+        :param feature: A function of a column returning the feature of the example in that column.
+        :param node: The position of the root of the tree in the compiled arrays.
+        :return: The position of the leaf in the compiled arrays.
+        """
+        return walklazy(feature, node, self.feature, self.value, self.left, self.right,
+                        treecomparison(self.maxbins))
+
+    def leafindex(self, X):
+        """
+        A function to get the leaf each of the examples ends up in on the compiled tree.
+
+        :param X: The test examples, one per row.
+        :return: The position of the leaf of each example in the compiled arrays.
+        """
+        return walktrees(np.asarray(X), [0], self.feature, self.value, self.left, self.right,
+                         treecomparison(self.maxbins))[0]
+
+    def build_tree(self, x, index=None, weight=None):
+        """
+        A function to build the tree based on the training set. The tree is grown one depth level at a time, the
+        splits of all the open nodes of a level are found in a single pass over the rows, and the rows are only
+        tracked by the open node they are in, so they are never copied into the branches.
 
         :param x: Training set
-        :param depth: Depth of the recursion
-        :return: The parent node at that level of the decision tree.
-        """
-        gain, question = self.find_best_split(x)
-        # print(question.val)
-        # print(question.col)
-        # print(question)
-        if gain != 0:
-            englishrows = []
-            dutchrows = []
-            for k in x:
-                if question.match(k) == False:
-                    dutchrows.append(k)
+        :param index: The indices of the rows of the training set to use, all of them if None.
+        :param weight: The weight of each of the rows of index in the gini impurity, all ones if None.
+        :return: The root node of the decision tree.
+        """
+        if isinstance(x, BitMatrix):
+            if index is None and weight is None and self.maxbins is None:
+                return self.build_tree_packed(x)
+            # Resampled or weighted rows cannot be counted with bit masks.
+            x = x.unpack()
+        if self.blocksize is not None:
+            return self.build_tree_blocks(x, index, weight)
+        if index is None:
+            index = np.arange(len(x))
+        labels = x[index, -1].astype(np.int64)
+        nclasses = labels.max() + 1
+        binner = None
+        if self.maxbins is not None:
+            # The rows are binned once and the nodes split on a bin, their threshold being the edge of that bin.
+            binner = Binner(self.maxbins).fit(x[index, :-1])
+            binned = binner.transform(x[index, :-1])
+            x = np.column_stack((binned, labels.astype(binned.dtype)))
+            index = np.arange(len(index))
+        nvalues = max(int(x[index, i].max()) for i in range(x.shape[1] - 1)) + 1
+
+        # nodeof holds the open node of each row, or -1 once the row has reached a leaf.
+        nodeof = np.zeros(len(index), dtype=np.int64)
+
+        def countlevel(split, nnodes):
+            return self.levelcounts(x, labels, nodeof, split, nnodes, nvalues, nclasses, weight, index)
+
+        return self.growlevels(countlevel, nclasses, binner)
+
+    def build_tree_blocks(self, x, index=None, weight=None):
+        """
+        A function to build the tree like build_tree does, but reading the training set blockwise. Each depth level
+        is a single pass over the blocks of rows, which first moves the rows of the block down the splits of the
+        previous level and then adds their label counts to those of the open nodes, so only a block of rows and the
+        node of each row are held in memory.
+
+        :param x: Training set, usually a np.memmap.
+        :param index: The indices of the rows of the training set to use, all of them if None.
+        :param weight: The weight of each of the rows of index in the gini impurity, all ones if None.
+        :return: The root node of the decision tree.
+        """
+        size = len(x) if index is None else len(index)
+        binner = None
+        if self.maxbins is not None:
+            # The bin edges are fitted on evenly spaced rows, which are all the rows of a training set of up to
+            # 2 ** 20 rows.
+            sample = np.unique(np.linspace(0, size - 1, min(size, 1 << 20)).astype(np.int64))
+            binner = Binner(self.maxbins).fit(np.asarray(x[sample if index is None else index[sample], :-1]))
+
+        nvalues, nclasses = 0, 0
+        for start in range(0, size, self.blocksize):
+            block, labels = self.readblock(x, index, start, binner)
+            nvalues = max(nvalues, int(block[:, :-1].max()) + 1)
+            nclasses = max(nclasses, int(labels.max()) + 1)
+
+        # nodeof holds the open node of each row, or -1 once the row has reached a leaf.
+        nodeof = np.zeros(size, dtype=np.int32)
+
+        def countlevel(split, nnodes):
+            totals, counts = 0, 0
+            for start in range(0, size, self.blocksize):
+                block, labels = self.readblock(x, index, start, binner)
+                blocktotals, blockcounts = self.levelcounts(
+                    block, labels, nodeof[start:start + self.blocksize], split, nnodes, nvalues, nclasses,
+                    None if weight is None else weight[start:start + self.blocksize])
+                totals, counts = totals + blocktotals, counts + blockcounts
+            return totals, counts
+
+        return self.growlevels(countlevel, nclasses, binner)
+
+    def growlevels(self, countlevel, nclasses, binner=None):
+        """
+        A function to grow the tree one depth level at a time from the label counts of the candidate splits of
+        each level, wherever the rows are. A level of nodes is grown before its rows are moved down, so the splits
+        of a level are handed to the counting of the next one.
+
+        :param countlevel: A function of the splits of the previous level, None at the root, and of the number of
+            open nodes, which moves the rows down those splits and returns the label counts of splitcounts summed
+            over all the rows.
+        :param nclasses: The number of labels, the labels being in range(nclasses).
+        :param binner: The fitted binner the rows were binned with, if any.
+        :return: The root node of the decision tree.
+        """
+        opennodes = [(None, None)]
+        split = None
+        root = None
+        depth = 0
+        while opennodes:
+            totals, counts = countlevel(split, len(opennodes))
+            gains, cols, vals, totals = self.bestsplits(totals, counts, self.maxbins is not None)
+
+            nextnodes = []
+            matchid = np.full(len(opennodes), -1)
+            restid = np.full(len(opennodes), -1)
+            for j, (parent, branch) in enumerate(opennodes):
+                if depth < self.maxdepth and gains[j] > 0:
+                    if self.maxbins is None:
+                        question = PartitionMatch(int(cols[j]), int(vals[j]))
+                    else:
+                        question = PartitionThreshold(int(cols[j]), float(binner.edges[cols[j]][vals[j]]))
+                    child = Node(question, None, None)
+                    matchid[j], restid[j] = len(nextnodes), len(nextnodes) + 1
+                    nextnodes += [(child, 'englishbranch'), (child, 'dutchbranch')]
                 else:
-                    englishrows.append(k)
-            englishbranch, dutchbranch = np.asarray(englishrows), np.asarray(dutchrows)
-            # englishbranch, dutchbranch = self.partition(x, question)
-            # print(englishbranch)
-            # print(dutchbranch)
+                    child = Leaf(self, None, {k: totals[j, k].item() for k in range(nclasses) if totals[j, k] > 0})
+                if parent is None:
+                    root = child
+                else:
+                    setattr(parent, branch, child)
+
+            split = cols, vals, matchid, restid
+            opennodes = nextnodes
+            depth += 1
 
-            if depth <= self.maxdepth:
-                depth -= 1
-                englishbranch = self.build_tree(englishbranch, depth)
-                dutchbranch = self.build_tree(dutchbranch, depth)
+        return root
 
+    def levelcounts(self, x, labels, nodes, split, nnodes, nvalues, nclasses, weight=None, index=None):
+        """
+        A function to move some rows of the training set down the splits of the previous level and count the
+        labels of the candidate splits of their open nodes. The counts of blocks or shards of the rows add up to
+        those of all the rows.
+
+        :param x: The rows, with the labels in the last column and their features binned if maxbins is set.
+        :param labels: The label of each of the rows.
+        :param nodes: The open node of each of the rows, or -1 for a leaf, updated in place.
+        :param split: The columns, values and matching and other child of the splits of the previous level, None
+            at the root.
+        :param nnodes: The number of open nodes.
+        :param nvalues: The number of distinct feature values, the features being in range(nvalues).
+        :param nclasses: The number of labels, the labels being in range(nclasses).
+        :param weight: The weight of each of the rows, all ones if None.
+        :param index: The indices of the rows in x, all the rows of x if None.
+        :return: The label counts of each node and of the rows of each node matching each column and value.
+        """
+        active = np.flatnonzero(nodes >= 0)
+        rows = active if index is None else index[active]
+        if split is not None:
+            cols, vals, matchid, restid = split
+            current = nodes[active]
+            if self.maxbins is None:
+                match = x[rows, cols[current]] == vals[current]
+            else:
+                match = x[rows, cols[current]] <= vals[current]
+            nodes[active] = np.where(match, matchid[current], restid[current])
+            keep = nodes[active] >= 0
+            active, rows = active[keep], rows[keep]
+        return self.splitcounts(x, rows, nodes[active].astype(np.int64), labels[active], nnodes, nvalues,
+                                nclasses, None if weight is None else weight[active])
+
+    def build_tree_packed(self, x):
+        """
+        A function to build the tree like build_tree does, on a bit packed training set of binary features. The
+        rows of each open node are a bit mask over the rows, and the label counts of every candidate split are the
+        population counts of the mask ANDed with the bits of a feature and of a label.
+
+        :param x: Training set, as a BitMatrix.
+        :return: The root node of the decision tree.
+        """
+        ncols = x.shape[1] - 1
+        labels = [x.valid & ~x.words[-1], x.words[-1]]
+        nclasses = 2 if BitMatrix.popcount(labels[1]).sum() > 0 else 1
+
+        # The masks of the open nodes, which the splits of each level replace by the masks of their children.
+        masks = [x.valid]
 
-        elif gain == 0:
-            return Leaf(self, x)
+        def countlevel(split, nnodes):
+            if split is not None:
+                cols, vals, matchid, restid = split
+                children = [None] * nnodes
+                for j, mask in enumerate(masks):
+                    if matchid[j] >= 0:
+                        match = mask & (x.words[cols[j]] if vals[j] else ~x.words[cols[j]])
+                        children[matchid[j]], children[restid[j]] = match, mask & ~match
+                masks[:] = children
 
-        return Node(question, englishbranch, dutchbranch)
+            # counts[n, c, v, k] is the number of rows of node n and label k whose feature c has the value v.
+            totals = np.empty((nnodes, 1, 1, nclasses), dtype=np.int64)
+            counts = np.empty((nnodes, ncols, 2, nclasses), dtype=np.int64)
+            for j, mask in enumerate(masks):
+                for k in range(nclasses):
+                    rows = mask & labels[k]
+                    totals[j, 0, 0, k] = BitMatrix.popcount(rows).sum()
+                    counts[j, :, 1, k] = BitMatrix.popcount(x.words[:-1] & rows).sum(axis=1)
+            counts[:, :, 0] = totals[:, 0] - counts[:, :, 1]
+            return totals, counts
+
+        return self.growlevels(countlevel, nclasses)
+
+    def readblock(self, x, index, start, binner=None):
+        """
+        A function to read a block of rows of the training set into memory.
+
+        :param x: Training set.
+        :param index: The indices of the rows of the training set to use, all of them if None.
+        :param start: The position of the first row of the block in index.
+        :param binner: The fitted binner to map the features to their bins with, if any.
+        :return: The rows of the block with the labels in the last column, and the labels.
+        """
+        rows = slice(start, start + self.blocksize) if index is None else index[start:start + self.blocksize]
+        block = np.asarray(x[rows])
+        labels = block[:, -1].astype(np.int64)
+        if binner is not None:
+            binned = binner.transform(block[:, :-1])
+            block = np.column_stack((binned, labels.astype(binned.dtype)))
+        return block, labels
+
+    def predict_blocks(self, x):
+        """
+        A function to classify the rows of a training set like predict_batch does, reading them blockwise.
+
+        :param x: Training set, with the labels in the last column.
+        :return: The predicted label of each row.
+        """
+        if isinstance(x, BitMatrix):
+            x = x.unpack()
+        if self.blocksize is None:
+            return self.predict_batch(x[:, :-1])
+        return np.concatenate([self.predict_batch(np.asarray(x[start:start + self.blocksize, :-1]))
+                               for start in range(0, len(x), self.blocksize)])
 
     def classify(self, x, node):
         """
@@ -95,13 +463,21 @@ class DecisionTree:
         :param node: The root node of the decision tree
         :return: The prediction.
         """
-        if isinstance(node, Leaf):
-            return node.pred
+        while not isinstance(node, Leaf):
+            if node.question.match(x):
+                node = node.englishbranch
+            else:
+                node = node.dutchbranch
+        return node.pred
 
-        if node.question.match(x):
-            return self.classify(x, node.englishbranch)
-        else:
-            return self.classify(x, node.dutchbranch)
+    def predictlabel(self, pred):
+        """
+        A function to get the label a leaf predicts, which is its most frequent label.
+
+        :param pred: The label counts of the leaf.
+        :return: The predicted label.
+        """
+        return max(pred, key=pred.get)
 
     def classcount(self, x):
         """
@@ -146,38 +522,106 @@ class DecisionTree:
         gain = self.gini(startnode) - p * self.gini(left) - (1 - p) * self.gini(right)
         return gain
 
-    def find_best_split(self, x):
+    def ginifromcounts(self, counts):
+        """
+        A function to get the gini impurity of many branches at once from their label counts.
+
+        :param counts: The label counts, with the labels along the last axis.
+        :return: The gini impurity of each of the branches.
+        """
+        total = counts.sum(axis=-1, keepdims=True)
+        prob = counts / np.where(total > 0, total, 1)
+        return 1 - np.sum(prob ** 2, axis=-1)
+
+    def splitgains(self, x, rows, nodes, labels, nnodes, nvalues, nclasses, weight=None, cumulative=False):
+        """
+        A function to find the best split of many nodes at once. The label counts of every candidate split of every
+        node are counted column by column over the rows, so no rows are copied. With weights, the counts are the
+        sums of the weights of the rows.
+
+        :param x: The training dataset.
+        :param rows: The indices of the rows of the training dataset.
+        :param nodes: The node each of the rows is in.
+        :param labels: The label of each of the rows.
+        :param nnodes: The number of nodes.
+        :param nvalues: The number of distinct feature values, the features being in range(nvalues).
+        :param nclasses: The number of labels, the labels being in range(nclasses).
+        :param weight: The weight of each of the rows, all ones if None.
+        :param cumulative: Whether a split on a value matches the rows up to that value instead of only that value.
+        :return: The best gain, column and value of each node, along with the label counts of each node.
+        """
+        totals, counts = self.splitcounts(x, rows, nodes, labels, nnodes, nvalues, nclasses, weight)
+        return self.bestsplits(totals, counts, cumulative)
+
+    def splitcounts(self, x, rows, nodes, labels, nnodes, nvalues, nclasses, weight=None):
+        """
+        A function to count the labels of every candidate split of many nodes at once.
+
+        :param x: The training dataset.
+        :param rows: The indices of the rows of the training dataset.
+        :param nodes: The node each of the rows is in.
+        :param labels: The label of each of the rows.
+        :param nnodes: The number of nodes.
+        :param nvalues: The number of distinct feature values, the features being in range(nvalues).
+        :param nclasses: The number of labels, the labels being in range(nclasses).
+        :param weight: The weight of each of the rows, all ones if None.
+        :return: The label counts of each node and of the rows of each node matching each column and value.
+        """
+        ncols = x.shape[1] - 1
+        totals = np.bincount(nodes * nclasses + labels, weights=weight,
+                             minlength=nnodes * nclasses).reshape(nnodes, 1, 1, nclasses)
+
+        # counts[n, c, v, k] is the number of rows of node n and label k whose feature c has the value v.
+        counts = np.empty((nnodes, ncols, nvalues, nclasses), dtype=totals.dtype)
+        for i in range(ncols):
+            column = x[rows, i].astype(np.int64)
+            counts[:, i] = np.bincount((nodes * nvalues + column) * nclasses + labels, weights=weight,
+                                       minlength=nnodes * nvalues * nclasses).reshape(nnodes, nvalues, nclasses)
+        return totals, counts
+
+    def bestsplits(self, totals, counts, cumulative=False):
+        """
+        A function to find the best split of many nodes at once from the label counts of splitcounts.
+
+        :param totals: The label counts of each node.
+        :param counts: The label counts of the rows of each node matching each column and value.
+        :param cumulative: Whether a split on a value matches the rows up to that value instead of only that value.
+        :return: The best gain, column and value of each node, along with the label counts of each node.
+        """
+        nnodes, nvalues, nclasses = counts.shape[0], counts.shape[2], counts.shape[3]
+        if cumulative:
+            counts = np.cumsum(counts, axis=2)
+        matched = counts.sum(axis=-1)
+        size = totals.sum(axis=-1)
+        p = matched / np.where(size > 0, size, 1)
+        gains = self.ginifromcounts(totals) - p * self.ginifromcounts(counts) - \
+            (1 - p) * self.ginifromcounts(totals - counts)
+        gains[(matched == 0) | (matched == size)] = -np.inf
+
+        # Candidates are ranked column by column and ties go to the last one, like the original loop did. The
+        # gains are rounded so that mirrored splits of a binary column tie instead of differing by rounding noise.
+        gains = np.round(gains.reshape(nnodes, -1), 12)
+        best = gains.shape[1] - 1 - np.argmax(gains[:, ::-1], axis=1)
+        bestgains = np.maximum(gains[np.arange(nnodes), best], 0)
+        return bestgains, best // nvalues, best % nvalues, totals.reshape(nnodes, nclasses)
+
+    def find_best_split(self, x, index=None):
         """
         A function to find the based node based on the gini impurity and information gain of node.
 
         :param x: The training dataset.
+        :param index: The indices of the rows of the training dataset to split, all of them if None.
         :return: The gain and the node which we find best divides the dataset.
         """
-        gain, question = 0, None
-        for i in range(10):
-            values = [0, 1]
-            for j in values:
-                # print(i,j)
-                currentquestion = PartitionMatch(i, j)
-                englishrows = []
-                dutchrows = []
-                for k in x:
-                    if currentquestion.match(k) == False:
-                        dutchrows.append(k)
-                    else:
-                        englishrows.append(k)
-                englishsplit, dutchsplit = np.asarray(englishrows), np.asarray(dutchrows)
-                if len(englishsplit) == 0 or len(dutchsplit) == 0:
-                    continue
-                currentgain = self.info_gain(x, englishsplit, dutchsplit)
-                # print()
-                if currentgain < gain:
-                    continue
-                else:
-                    gain = currentgain
-                    question = currentquestion
-
-        return gain, question
+        if index is None:
+            index = np.arange(len(x))
+        nvalues = max(int(x[index, i].max()) for i in range(x.shape[1] - 1)) + 1
+        labels = x[index, -1].astype(np.int64)
+        gains, cols, vals, totals = self.splitgains(x, index, np.zeros(len(index), dtype=np.int64), labels, 1,
+                                                    nvalues, labels.max() + 1)
+        if gains[0] == 0:
+            return 0, None
+        return gains[0], PartitionMatch(int(cols[0]), int(vals[0]))
 
 
 class PartitionMatch:
@@ -202,19 +646,151 @@ class PartitionMatch:
         return sample[self.col] == self.val
 
 
+class PartitionThreshold:
+
+    def __init__(self, col, val):
+        """
+        Class initialisation to store the structure of the tree, for real valued features.
+
+        :param col: The feature which is at the node.
+        :param val: The threshold of the feature.
+        """
+        self.col = col
+        self.val = val
+
+    def match(self, sample):
+        """
+        A function to get what a particular node predicts.
+
+        :param sample: The value of the feature.
+        :return: Binary, whether the feature is below the threshold.
+        """
+        return sample[self.col] < self.val
+
+
+class Binner:
+
+    def __init__(self, maxbins=32):
+        """
+        Binner initialisation, the bin edges are set by fit.
+
+        :param maxbins: The maximum number of bins of each feature.
+        """
+        self.maxbins = maxbins
+        self.edges = None
+
+    def fit(self, X):
+        """
+        A function to compute the bin edges of each feature. A feature with few distinct values gets one bin per
+        value, the others get quantile bins.
+
+        :param X: The features of the training dataset.
+        :return: The fitted binner.
+        """
+        self.edges = []
+        for i in range(X.shape[1]):
+            values = np.unique(X[:, i])
+            if len(values) > self.maxbins:
+                values = np.unique(np.quantile(X[:, i], np.linspace(0, 1, self.maxbins)))
+            self.edges.append((values[:-1] + values[1:]) / 2)
+        return self
+
+    def transform(self, X):
+        """
+        A function to map the features to their bins, a value below the edge of a bin falling in that bin.
+
+        :param X: The features, one example per row.
+        :return: The bin of each of the features, as small integers.
+        """
+        binned = np.empty(X.shape, dtype=np.uint8 if self.maxbins <= 256 else np.int64)
+        for i, edges in enumerate(self.edges):
+            binned[:, i] = np.searchsorted(edges, X[:, i], side='right')
+        return binned
+
+
+class BitMatrix:
+
+    def __init__(self, X):
+        """
+        Bit matrix initialisation. Each column of a matrix of binary values is packed into 64 bit words, 64 rows
+        to a word, so the matrix takes a bit per value.
+
+        :param X: The matrix of zeros and ones, one example per row.
+        """
+        X = np.asarray(X)
+        self.shape = X.shape
+        nwords = (len(X) + 63) // 64
+        packed = np.zeros((X.shape[1], nwords * 8), dtype=np.uint8)
+        packed[:, :(len(X) + 7) // 8] = np.packbits(X.T != 0, axis=1, bitorder='little')
+        self.words = packed.view(np.uint64)
+        # The bits of the rows past the end of the matrix in the last word are cleared by the mask of valid rows.
+        valid = np.zeros(nwords * 8, dtype=np.uint8)
+        valid[:(len(X) + 7) // 8] = np.packbits(np.ones(len(X), dtype=bool), bitorder='little')
+        self.valid = valid.view(np.uint64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def column(self, i):
+        """
+        A function to unpack a single column of the matrix.
+
+        :param i: The index of the column.
+        :return: The values of the column.
+        """
+        return np.unpackbits(self.words[i].view(np.uint8), count=self.shape[0], bitorder='little')
+
+    def unpack(self):
+        """
+        A function to unpack the whole matrix.
+
+        :return: The matrix, with a byte per value.
+        """
+        return np.unpackbits(self.words.view(np.uint8), axis=1, count=self.shape[0], bitorder='little').T
+
+    @staticmethod
+    def popcount(words):
+        """
+        A function to count the bits set in each of the words.
+
+        :param words: The 64 bit words.
+        :return: The number of bits set in each word.
+        """
+        if hasattr(np, 'bitwise_count'):
+            return np.bitwise_count(words)
+        return np.unpackbits(words.view(np.uint8)).reshape(words.shape + (64,)).sum(axis=-1, dtype=np.uint8)
+
+
 class Adaboost():
 
-    def __init__(self, X_train, y, n_trees=2):
+    def __init__(self, X_train, y, n_trees=2, weighted=False, maxdepth=5, maxbins=None, blocksize=None):
         """
         Initialisation of the adaboost class.
 
         :param X_train: The training dataset.
         :param y: The target value
         :param n_trees: Number of decision stump inside the adaboost.
+        :param weighted: Whether to train on weighted samples (SAMME) instead of resampling the training dataset.
+        :param maxdepth: The maximum depth of the trees in the weighted mode.
+        :param maxbins: The number of quantile bins of the trees, for real valued features.
+        :param blocksize: The number of rows the trees read at a time in the weighted mode, for a training dataset
+            on disk. The whole training dataset is used at once if None.
         """
         self.n_trees = n_trees
+        self.weighted = weighted
+        self.maxdepth = maxdepth
+        self.maxbins = maxbins
+        self.blocksize = blocksize
         self.y = y
         self.X_train = X_train
+        self.extractor = None
+        self.lookup = None
+        self.roots = None
+        self.feature = None
+        self.value = None
+        self.left = None
+        self.right = None
+        self.leafclass = None
 
     def train(self, X_train):
         """
@@ -223,6 +799,9 @@ class Adaboost():
         :param X_train: The training dataset.
 
         """
+        if self.weighted:
+            return self.train_weighted(X_train)
+
         exampleweight = [1 / len(X_train)] * len(X_train)
         modelweight = [0.5] * self.n_trees
 
@@ -237,8 +816,9 @@ class Adaboost():
 
                 randomsamples = [X_train[i] for i in index]
                 randomsamples = np.asarray(randomsamples)
-                models[i] = DecisionTree(randomsamples, randomsamples[:, -1], maxdepth=5)
+                models[i] = DecisionTree(randomsamples, randomsamples[:, -1], maxdepth=5, maxbins=self.maxbins)
                 dt[i] = models[i].build_tree(randomsamples)
+                models[i].rootnode(dt[i])
 
                 answers = []
                 for j in X_train:
@@ -276,6 +856,90 @@ class Adaboost():
         self.modelweight = modelweight
         self.models = models
         self.dt = dt
+        self.compile_ensemble()
+
+    def train_weighted(self, X_train):
+        """
+        A function to train the adaboost with the SAMME algorithm. Each tree is built on the whole training dataset
+        with the example weights used in its gini impurity, and the weights of the misclassified examples are then
+        increased according to the weight of the tree.
+
+        :param X_train: The training dataset.
+        """
+        labels = X_train[:, -1].astype(np.int64)
+        nclasses = labels.max() + 1
+        exampleweight = np.full(len(X_train), 1 / len(X_train))
+        modelweight, models, dt = [], [], []
+        for i in range(self.n_trees):
+            model = DecisionTree(X_train, labels, maxdepth=self.maxdepth, maxbins=self.maxbins,
+                                 blocksize=self.blocksize)
+            model.rootnode(model.build_tree(X_train, weight=exampleweight))
+            wrong = model.predict_blocks(X_train) != labels
+
+            error = np.clip(exampleweight @ wrong / exampleweight.sum(), 1e-10, None)
+            if error >= 1 - 1 / nclasses:
+                # A tree no better than chance adds nothing, keep it only if it is the first one.
+                if not models:
+                    modelweight.append(1.0)
+                    models.append(model)
+                    dt.append(model.dt)
+                break
+            alpha = np.log((1 - error) / error) + np.log(nclasses - 1)
+            modelweight.append(alpha)
+            models.append(model)
+            dt.append(model.dt)
+            if not wrong.any():
+                break
+
+            exampleweight = exampleweight * np.exp(alpha * wrong)
+            exampleweight = exampleweight / exampleweight.sum()
+
+        self.modelweight = modelweight
+        self.models = models
+        self.dt = dt
+        self.compile_ensemble()
+
+    def compile_ensemble(self):
+        """
+        A function to stack the compiled arrays of all the trees into a single set of arrays.
+        """
+        self.roots, self.feature, self.left, self.right, self.value, self.leafclass = stacktrees(
+            [(model.feature, model.left, model.right, model.value, model.leafclass) for model in self.models])
+
+    def vote(self, X):
+        """
+        A function to get the weighted vote of the trees for many examples at once. Every tree is evaluated on
+        every example together, all of them moving down one level of their tree at a time.
+
+        :param X: The test examples, one per row.
+        :return: The weighted vote for the English label of each example.
+        """
+        node = walktrees(np.asarray(X), self.roots, self.feature, self.value, self.left, self.right,
+                         treecomparison(self.maxbins))
+        return np.asarray(self.modelweight, dtype=np.float64) @ self.leafclass[node] / sum(self.modelweight)
+
+    def predict_lazy(self, feature):
+        """
+        A function to classify a single example with the weighted vote of the trees, asking for its features only
+        at the nodes of the paths of the trees. The features the trees share are computed once.
+
+        :param feature: A function of a column returning the feature of the example in that column.
+        :return: The predicted label of the example.
+        """
+        compare = treecomparison(self.maxbins)
+        leaves = [walklazy(feature, root, self.feature, self.value, self.left, self.right, compare)
+                  for root in self.roots]
+        vote = np.asarray(self.modelweight, dtype=np.float64) @ self.leafclass[leaves] / sum(self.modelweight)
+        return int(vote > 0.5)
+
+    def predict_batch(self, X):
+        """
+        A function to classify many examples at once with the weighted vote of the trees.
+
+        :param X: The test examples, one per row.
+        :return: The predicted label of each example.
+        """
+        return (self.vote(X) > 0.5).astype(np.int64)
 
     def classify(self, X_train):
         """
@@ -284,28 +948,423 @@ class Adaboost():
         :param X_train: The test example dataset.
 
         """
-        modelweight = self.modelweight
-        models = self.models
-        dt = self.dt
-        finalresults = [None] * self.n_trees
+        answers = self.predict_batch(X_train)
+        print('\n'.join("en" if i == 1 else "nl" for i in answers))
+
+
+def growforesttree(x, seed, maxdepth=5, maxbins=None, maxfeatures=None):
+    """
+    A function to grow a tree of a RandomForest on a bootstrap sample of the rows and a random subset of the
+    features of the training dataset.
+
+    :param x: The training dataset.
+    :param seed: The seed of the random sample of the tree.
+    :param maxdepth: The maximum depth of the tree.
+    :param maxbins: The number of quantile bins of the tree, for real valued features.
+    :param maxfeatures: The number of features the tree is grown on, all of them if None.
+    :return: The root node of the tree.
+    """
+    rng = np.random.default_rng(seed)
+    index = rng.integers(0, len(x), len(x))
+    tree = DecisionTree(maxdepth=maxdepth, maxbins=maxbins)
+    ncols = x.shape[1] - 1
+    if maxfeatures is None or maxfeatures >= ncols:
+        return tree.build_tree(x, index)
+
+    cols = np.sort(rng.choice(ncols, maxfeatures, replace=False))
+    root = tree.build_tree(x[np.ix_(index, np.append(cols, ncols))])
+    # The questions are asked on the columns of the sample, they are mapped back to those of the dataset.
+    nodes = [root]
+    for node in nodes:
+        if isinstance(node, Node):
+            node.question.col = int(cols[node.question.col])
+            nodes += [node.englishbranch, node.dutchbranch]
+    return root
+
+
+def initforestworker(name, shape, dtype, settings):
+    """
+    A function to attach a worker process of RandomForest.train to the training dataset in shared memory, once per
+    worker.
+
+    :param name: The name of the shared memory block.
+    :param shape: The shape of the training dataset.
+    :param dtype: The type of the training dataset.
+    :param settings: The maxdepth, maxbins and maxfeatures of the trees.
+    """
+    global FORESTMEMORY, FORESTMATRIX, FORESTSETTINGS
+    FORESTMEMORY = shared_memory.SharedMemory(name=name)
+    FORESTMATRIX = np.ndarray(shape, dtype=dtype, buffer=FORESTMEMORY.buf)
+    FORESTSETTINGS = settings
+
+
+def growworkertree(seed):
+    """
+    A function to grow a tree of a RandomForest in a worker process.
+
+    :param seed: The seed of the random sample of the tree.
+    :return: The root node of the tree.
+    """
+    return growforesttree(FORESTMATRIX, seed, *FORESTSETTINGS)
+
+
+class RandomForest(Adaboost):
+
+    def __init__(self, X_train, y, n_trees=50, maxdepth=5, maxbins=None, maxfeatures=None, workers=1, seed=0):
+        """
+        Initialisation of the random forest, an ensemble of trees grown independently on bootstrap samples of the
+        rows and random subsets of the features, which classifies by the majority vote of the trees.
+
+        :param X_train: The training dataset.
+        :param y: The target value
+        :param n_trees: Number of trees of the forest.
+        :param maxdepth: The maximum depth of the trees.
+        :param maxbins: The number of quantile bins of the trees, for real valued features.
+        :param maxfeatures: The number of features each tree is grown on, all of them if None.
+        :param workers: The number of processes to grow the trees with.
+        :param seed: The seed of the random samples of the trees.
+        """
+        super().__init__(X_train, y, n_trees, maxdepth=maxdepth, maxbins=maxbins)
+        self.maxfeatures = maxfeatures
+        self.workers = workers
+        self.seed = seed
+
+    def train(self, X_train):
+        """
+        A function to grow the trees of the forest. With more than one worker, the training dataset is copied into
+        shared memory once and a pool of processes grows the trees, each process reading the dataset from there.
+
+        :param X_train: The training dataset.
+        """
+        X_train = np.ascontiguousarray(X_train)
+        seeds = [(self.seed, i) for i in range(self.n_trees)]
+        settings = (self.maxdepth, self.maxbins, self.maxfeatures)
+        if self.workers > 1:
+            memory = shared_memory.SharedMemory(create=True, size=max(X_train.nbytes, 1))
+            try:
+                np.ndarray(X_train.shape, dtype=X_train.dtype, buffer=memory.buf)[...] = X_train
+                with multiprocessing.Pool(self.workers, initializer=initforestworker,
+                                          initargs=(memory.name, X_train.shape, X_train.dtype.str, settings)) as pool:
+                    dt = pool.map(growworkertree, seeds)
+            finally:
+                memory.close()
+                memory.unlink()
+        else:
+            dt = [growforesttree(X_train, seed, *settings) for seed in seeds]
+
+        models = []
+        for root in dt:
+            model = DecisionTree(maxdepth=self.maxdepth, maxbins=self.maxbins)
+            model.rootnode(root)
+            models.append(model)
+        self.modelweight = [1.0] * self.n_trees
+        self.models = models
+        self.dt = dt
+        self.compile_ensemble()
+
+
+class GradientBoosting:
+
+    def __init__(self, X_train, y, n_trees=100, learningrate=0.1, maxdepth=3, maxbins=32, validation=0.1,
+                 patience=10, l2=1.0, seed=0):
+        """
+        Initialisation of the histogram based gradient boosting class, which minimises the log loss.
+
+        :param X_train: The training dataset.
+        :param y: The target value
+        :param n_trees: The maximum number of trees.
+        :param learningrate: The shrinkage applied to the values of the leaves of each tree.
+        :param maxdepth: The maximum depth of the trees.
+        :param maxbins: The maximum number of bins of each feature.
+        :param validation: The fraction of the training dataset held out for early stopping, none if 0.
+        :param patience: The number of trees without improvement of the validation loss before stopping.
+        :param l2: The regularisation of the values of the leaves.
+        :param seed: The seed of the split of the validation dataset.
+        """
+        self.n_trees = n_trees
+        self.learningrate = learningrate
+        self.maxdepth = maxdepth
+        self.maxbins = maxbins
+        self.validation = validation
+        self.patience = patience
+        self.l2 = l2
+        self.seed = seed
+        self.y = y
+        self.extractor = None
+        self.lookup = None
+        self.binner = None
+        self.baseline = 0.0
+        self.trees = []
+        self.roots = None
+        self.feature = None
+        self.threshold = None
+        self.left = None
+        self.right = None
+        self.value = None
+
+    def grow_tree(self, binned, grad, hess):
+        """
+        A function to grow a tree on the gradient and hessian of the loss. The tree is grown one depth level at a
+        time from the gradient and hessian histograms of the bins of every feature. A node sends the rows whose bin
+        is at most its threshold to the left.
+
+        :param binned: The binned features of the training dataset.
+        :param grad: The gradient of the loss for each row.
+        :param hess: The hessian of the loss for each row.
+        :return: The tree as arrays of feature, threshold, left child, right child and value, along with the leaf
+            of each row.
+        """
+        nbins = max(len(edges) for edges in self.binner.edges) + 1
+        ncols = binned.shape[1]
+        feature, threshold, left, right, value = [-1], [0], [-1], [-1], [0.0]
+        nodeof = np.zeros(len(binned), dtype=np.int64)
+        leafof = np.zeros(len(binned), dtype=np.int64)
+        opennodes = [0]
+        for depth in range(self.maxdepth + 1):
+            active = np.flatnonzero(nodeof >= 0)
+            nodes = nodeof[active]
+            G = np.bincount(nodes, weights=grad[active], minlength=len(opennodes))
+            H = np.bincount(nodes, weights=hess[active], minlength=len(opennodes))
+
+            gains = np.full((len(opennodes), ncols, nbins), -np.inf)
+            if depth < self.maxdepth:
+                for i in range(ncols):
+                    key = nodes * nbins + binned[active, i]
+                    GL = np.cumsum(np.bincount(key, weights=grad[active], minlength=len(opennodes) * nbins)
+                                   .reshape(-1, nbins), axis=1)
+                    HL = np.cumsum(np.bincount(key, weights=hess[active], minlength=len(opennodes) * nbins)
+                                   .reshape(-1, nbins), axis=1)
+                    GR, HR = G[:, None] - GL, H[:, None] - HL
+                    gain = GL ** 2 / (HL + self.l2) + GR ** 2 / (HR + self.l2) - (G ** 2 / (H + self.l2))[:, None]
+                    gain[(HL <= 1e-12) | (HR <= 1e-12)] = -np.inf
+                    gains[:, i] = gain
+            gains = gains.reshape(len(opennodes), -1)
+            best = np.argmax(gains, axis=1)
+
+            nextnodes = []
+            leftid = np.full(len(opennodes), -1)
+            rightid = np.full(len(opennodes), -1)
+            for j, node in enumerate(opennodes):
+                if gains[j, best[j]] > 1e-12:
+                    feature[node], threshold[node] = int(best[j] // nbins), int(best[j] % nbins)
+                    left[node], right[node] = len(feature), len(feature) + 1
+                    leftid[j], rightid[j] = len(nextnodes), len(nextnodes) + 1
+                    nextnodes += [len(feature), len(feature) + 1]
+                    feature += [-1, -1]
+                    threshold += [0, 0]
+                    left += [-1, -1]
+                    right += [-1, -1]
+                    value += [0.0, 0.0]
+                else:
+                    value[node] = -self.learningrate * G[j] / (H[j] + self.l2)
+
+            leaf = leftid[nodes] < 0
+            leafof[active[leaf]] = np.asarray(opennodes, dtype=np.int64)[nodes[leaf]]
+            cols = best[nodes] // nbins
+            goleft = binned[active, cols] <= best[nodes] % nbins
+            nodeof[active] = np.where(leaf, -1, np.where(goleft, leftid[nodes], rightid[nodes]))
+            opennodes = nextnodes
+            if not opennodes:
+                break
+
+        tree = (np.asarray(feature, dtype=np.int64), np.asarray(threshold, dtype=np.int64),
+                np.asarray(left, dtype=np.int64), np.asarray(right, dtype=np.int64), np.asarray(value))
+        return tree, leafof
+
+    def treevalues(self, tree, binned):
+        """
+        A function to get the value of a single tree for each row.
+
+        :param tree: The tree arrays, as returned by grow_tree.
+        :param binned: The binned features.
+        :return: The value of the leaf of each row.
+        """
+        feature, threshold, left, right, value = tree
+        # The rows of a bin at most the threshold go left.
+        return value[walktrees(binned, [0], feature, threshold, left, right, operator.le)[0]]
+
+    def logloss(self, raw, labels):
+        """
+        A function to get the average log loss of the raw scores.
+
+        :param raw: The raw score of each row, the log odds of the English label.
+        :param labels: The label of each row.
+        :return: The average log loss.
+        """
+        return np.mean(np.logaddexp(0, raw) - labels * raw)
+
+    def train(self, X_train):
+        """
+        A function to train the gradient boosting trees. Each tree is fit on the gradient and hessian of the log
+        loss of the previous trees, and training stops once the loss on the held out validation rows has not
+        improved for patience trees.
+
+        :param X_train: The training dataset.
+        """
+        X = X_train[:, :-1]
+        labels = X_train[:, -1].astype(np.float64)
+        self.binner = Binner(self.maxbins).fit(X)
+        binned = self.binner.transform(X)
+
+        order = np.random.RandomState(self.seed).permutation(len(X))
+        nvalidation = int(len(X) * self.validation)
+        validation, training = order[:nvalidation], order[nvalidation:]
+
+        prior = np.clip(labels[training].mean(), 1e-6, 1 - 1e-6)
+        self.baseline = float(np.log(prior / (1 - prior)))
+        raw = np.full(len(training), self.baseline)
+        validationraw = np.full(len(validation), self.baseline)
+        bestloss, bestround = np.inf, 0
+
+        self.trees = []
         for i in range(self.n_trees):
-            answers = []
-            for j in X_train:
-                answers.append(models[i].classify(j, dt[i]))
-            finalresults[i] = answers
-
-        averageresult = [0] * len(self.y)
-        for j in range(len(self.y)):
-            for i in range(len(finalresults)):
-                for k in finalresults[i][j]:
-                    if 0 == k:
-                        averageresult[j] += modelweight[i] * 0
-                    elif 1 == k:
-                        averageresult[j] += modelweight[i] * 1
-            averageresult[j] = averageresult[j] / sum(modelweight)
-
-        for i in averageresult:
-            if i > 0.5:
-                print("en")
-            else:
-                print("nl")
+            prob = 1 / (1 + np.exp(-raw))
+            tree, leafof = self.grow_tree(binned[training], prob - labels[training], prob * (1 - prob))
+            self.trees.append(tree)
+            raw += tree[4][leafof]
+
+            if nvalidation:
+                validationraw += self.treevalues(tree, binned[validation])
+                loss = self.logloss(validationraw, labels[validation])
+                if loss < bestloss - 1e-9:
+                    bestloss, bestround = loss, i + 1
+                elif i + 1 - bestround >= self.patience:
+                    break
+        if nvalidation:
+            self.trees = self.trees[:bestround]
+        self.compile_ensemble()
+
+    def compile_ensemble(self):
+        """
+        A function to stack the arrays of all the trees into a single set of arrays, an ensemble without any tree
+        getting a single leaf.
+        """
+        trees = self.trees
+        if not trees:
+            # Without any tree, every example gets the baseline score from a single empty leaf.
+            trees = [(np.array([-1]), np.array([0]), np.array([-1]), np.array([-1]), np.array([0.0]))]
+        self.roots, self.feature, self.left, self.right, self.threshold, self.value = stacktrees(
+            [(feature, left, right, threshold, value) for feature, threshold, left, right, value in trees])
+
+    def decision_function(self, X):
+        """
+        A function to get the raw score of many examples at once, every tree being evaluated on every example
+        together.
+
+        :param X: The test examples, one per row.
+        :return: The log odds of the English label for each example.
+        """
+        binned = self.binner.transform(np.asarray(X))
+        node = walktrees(binned, self.roots, self.feature, self.threshold, self.left, self.right, operator.le)
+        return self.baseline + self.value[node].sum(axis=0)
+
+    def predict_batch(self, X):
+        """
+        A function to classify many examples at once.
+
+        :param X: The test examples, one per row.
+        :return: The predicted label of each example.
+        """
+        return (self.decision_function(X) > 0).astype(np.int64)
+
+
+class Cascade:
+
+    def __init__(self, first, model, margin=0.8):
+        """
+        Cascade initialisation. A small first stage tree answers for the examples ending in one of its leaves whose
+        label counts are clear enough, which it tells from a few cheap features, and the model answers for the
+        others.
+
+        :param first: The trained first stage DecisionTree.
+        :param model: The trained model.
+        :param margin: The smallest margin of a leaf of the first stage for it to answer, the margin being the
+            difference of the two largest label counts of the leaf over its total count.
+        """
+        self.first = first
+        self.model = model
+        self.margin = margin
+        self.extractor = None
+        self.lookup = None
+        self.examples = 0
+        self.earlyexits = 0
+
+    def leafmargin(self, X):
+        """
+        A function to get the margin of the first stage leaf of many examples at once.
+
+        :param X: The test examples, one per row.
+        :return: The margin of the leaf of each example.
+        """
+        counts = np.sort(self.first.leafcounts[self.first.leafindex(X)], axis=1)
+        total = counts.sum(axis=1)
+        second = counts[:, -2] if counts.shape[1] > 1 else 0
+        return (counts[:, -1] - second) / np.where(total > 0, total, 1)
+
+    def firststage(self, X):
+        """
+        A function to classify many examples at once with the first stage, counting the early exits.
+
+        :param X: The test examples, one per row, of which only the columns the first stage tests are read.
+        :return: The label the first stage predicts for each example, and whether its leaf is clear enough.
+        """
+        confident = self.leafmargin(X) >= self.margin
+        self.examples += len(confident)
+        self.earlyexits += int(confident.sum())
+        return self.first.predict_batch(X), confident
+
+    def predict_batch(self, X):
+        """
+        A function to classify many examples at once, the model classifying only those the first stage leaves.
+
+        :param X: The test examples, one per row.
+        :return: The predicted label of each example.
+        """
+        X = np.asarray(X)
+        labels, confident = self.firststage(X)
+        rest = np.flatnonzero(~confident)
+        if len(rest):
+            model = self.model if self.model.lookup is None else self.model.lookup
+            labels[rest] = model.predict_batch(X[rest])
+        return labels
+
+    def exitrate(self):
+        """
+        A function to get the fraction of the examples classified so far which the first stage answered.
+
+        :return: The fraction of early exits.
+        """
+        return self.earlyexits / max(self.examples, 1)
+
+
+class LookupTable:
+
+    def __init__(self, model, nfeatures=10, maxfeatures=16):
+        """
+        Lookup table initialisation. A model over binary features is a function of a nfeatures bit number, so it is
+        evaluated once on every possible feature row and inference becomes a table lookup.
+
+        :param model: The trained DecisionTree or Adaboost model.
+        :param nfeatures: The number of feature columns.
+        :param maxfeatures: The number of feature columns above which no table is built.
+        """
+        self.model = model
+        self.nfeatures = nfeatures
+        self.bits = 1 << np.arange(nfeatures, dtype=np.int64)
+        self.table = None
+        if nfeatures <= maxfeatures:
+            rows = (np.arange(2 ** nfeatures)[:, None] & self.bits) > 0
+            self.table = model.predict_batch(rows.astype(np.int64))
+
+    def predict_batch(self, X):
+        """
+        A function to classify many examples at once by packing each feature row into an integer and looking it up
+        in the table. The model is used instead when the features are not all binary.
+
+        :param X: The test examples, one per row.
+        :return: The predicted label of each example.
+        """
+        X = np.asarray(X)
+        if self.table is None or X.shape[1] != self.nfeatures or np.any((X != 0) & (X != 1)):
+            return self.model.predict_batch(X)
+        return self.table[X.astype(np.int64) @ self.bits]
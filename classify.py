@@ -1,4 +1,4 @@
-from utils import train, predict
+from utils import train, predict, predictstream
 
 def main():
     """
@@ -15,7 +15,11 @@ def main():
             hypothesisOut = command[2]
             learning_type = command[3]
             print("Starting training...")
-            train(examples, hypothesisOut, learning_type)
+            try:
+                train(examples, hypothesisOut, learning_type)
+            except ValueError as error:
+                print(error)
+                continue
             print("Training is done.")
 
         elif command[0] == 'predict':
@@ -25,6 +29,12 @@ def main():
             print("The predictions are: ")
             predictions = predict(hypothesis, file)
 
+        elif command[0] == 'stream':
+            # Like predict, the data comes before the model: stream [file] <model>, reading stdin without a file.
+            file = command[1] if len(command) > 2 else None
+            hypothesis = command[-1]
+            predictstream(hypothesis, file)
+
 
 if __name__ == '__main__':
     main()
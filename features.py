@@ -1,5 +1,16 @@
+import heapq
+import multiprocessing
 from collections import Counter
 
+import numpy as np
+
+# The version of the features, to be increased whenever a change makes them differ for the same corpus.
+FEATUREVERSION = 1
+
+# The columns of the features computed from the word lengths and from set lookups only, which skip the counting and
+# ranking of the characters of each sentence the other features need.
+CHEAPFEATURES = [0, 3, 4, 7, 8]
+
 
 def lengthofwords(english, dutch, data):
     """
@@ -438,3 +449,659 @@ def wordswithrepeatingletters(english, dutch, data):
 
     return feature
     #return [0,0,0,0,0,0,0,0,0,0]
+
+
+def striplabel(sentence):
+    """
+    A function to remove the language label from a sentence, if it has one.
+
+    :param sentence: A sentence, optionally prefixed with "en|" or "nl|".
+    :return: The sentence without the label.
+    """
+    if sentence[:3] in ('en|', 'nl|'):
+        return sentence[3:]
+    return sentence
+
+
+def topletters(counter):
+    """
+    A function to get the ten most frequent letters of a counter, ignoring spaces. Ties are broken by first
+    occurence, the same way repeated max/pop calls on the counter would.
+
+    :param counter: A Counter of the characters.
+    :return: The list of the ten most frequent letters.
+    """
+    return [i[0] for i in counter.most_common(11) if i[0] != ' '][:10]
+
+
+# The code points str.split treats as word separators.
+WHITESPACE = np.asarray([i for i in range(0x3001) if chr(i).isspace()], dtype=np.uint32)
+
+
+def firstcounts(keys):
+    """
+    A function to count the distinct keys in order of first occurence, the order a Counter would keep them in.
+
+    :param keys: The keys, in order of occurence.
+    :return: The position of the first occurence of each distinct key and its count.
+    """
+    keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    return first[order], counts[order]
+
+
+def labelledcorpus(corpus):
+    """
+    A function to load the labelled corpus into a columnar corpus of the lowercased english and dutch sentences.
+
+    :param corpus: The labelled training data, one "en|" or "nl|" prefixed sentence per line.
+    :return: The Corpus, labelled 1 for english and 0 for dutch.
+    """
+    sentences, labels = [], []
+    for i in corpus:
+        if i.startswith("nl|"):
+            sentences.append(i[3:].lower())
+            labels.append(0)
+        elif i.startswith("en|"):
+            sentences.append(i[3:].lower())
+            labels.append(1)
+    return Corpus(sentences, labels)
+
+
+class Corpus:
+    """
+    Holds sentences as one array of code points and the offset of each sentence in it, so the statistics of all the
+    sentences are computed with a few array operations instead of going over the sentences one by one.
+    """
+
+    def __init__(self, sentences, labels=None):
+        """
+        Corpus initialisation, which also finds the words of the sentences.
+
+        :param sentences: The sentences without their label.
+        :param labels: The label of each sentence, 1 for english and 0 for dutch, if known.
+        """
+        lengths = np.asarray([len(i) for i in sentences], dtype=np.int64)
+        self.size = len(sentences)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+        self.codes = np.frombuffer(''.join(sentences).encode('utf-32-le'), dtype=np.uint32)
+        self.labels = None if labels is None else np.asarray(labels, dtype=np.int8)
+        self.sentenceof = np.repeat(np.arange(self.size), lengths)
+
+        # A word starts at a letter following a space or starting a sentence, like str.split finds them.
+        inword = ~np.isin(self.codes, WHITESPACE)
+        start = inword.copy()
+        start[1:] &= ~inword[:-1]
+        start[self.offsets[:-1][lengths > 0]] = inword[self.offsets[:-1][lengths > 0]]
+        self.wordstart = np.flatnonzero(start)
+        self.inword = inword
+        self.wordof = np.cumsum(start) - 1
+        self.wordlength = np.bincount(self.wordof[inword], minlength=len(self.wordstart))
+        self.wordsentence = self.sentenceof[self.wordstart]
+
+    def charcounts(self, rows=None):
+        """
+        A function to count the distinct characters of each sentence.
+
+        :param rows: A boolean mask of the code points to count, all of them if None.
+        :return: The sentence, the character, the count and the position of the first occurence of each distinct
+            character of each sentence, sorted by sentence and character.
+        """
+        positions = np.arange(len(self.codes)) if rows is None else np.flatnonzero(rows)
+        keys = self.sentenceof[positions].astype(np.uint64) << np.uint64(21) | self.codes[positions]
+        keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        return ((keys >> np.uint64(21)).astype(np.int64), (keys & np.uint64(0x1FFFFF)).astype(np.uint32), counts,
+                positions[first])
+
+    def distinctletters(self):
+        """
+        A function to count the distinct letters of each word.
+
+        :return: The number of distinct letters of each word.
+        """
+        keys = np.sort(self.wordof[self.inword].astype(np.uint64) << np.uint64(21) | self.codes[self.inword])
+        distinct = np.ones(len(keys), dtype=bool)
+        distinct[1:] = keys[1:] != keys[:-1]
+        return np.bincount((keys[distinct] >> np.uint64(21)).astype(np.int64), minlength=len(self.wordstart))
+
+    def wordkeys(self):
+        """
+        A function to hash each word into a 64 bit key from its letters and its length.
+
+        :return: The key of each word.
+        """
+        letters = self.codes[self.inword].astype(np.uint64)
+        if not len(letters):
+            return np.zeros(0, dtype=np.uint64)
+        position = np.arange(len(letters)) - np.repeat(np.cumsum(self.wordlength) - self.wordlength, self.wordlength)
+        powers = np.ones(self.wordlength.max(), dtype=np.uint64)
+        powers[1:] = np.cumprod(np.full(len(powers) - 1, 1000003, dtype=np.uint64))
+        hashes = np.add.reduceat(letters * powers[position], np.cumsum(self.wordlength) - self.wordlength)
+        return hashes ^ (self.wordlength.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+
+    def word(self, i):
+        """
+        A function to get a word back as a string.
+
+        :param i: The index of the word.
+        :return: The word.
+        """
+        start = self.wordstart[i]
+        return self.codes[start:start + self.wordlength[i]].tobytes().decode('utf-32-le')
+
+
+def initworker(extractor):
+    """
+    A function to hand the fitted extractor to a worker process of FeatureExtractor.transform, once per worker.
+
+    :param extractor: The fitted feature extractor.
+    """
+    global WORKEREXTRACTOR
+    WORKEREXTRACTOR = extractor
+
+
+def transformshard(shard):
+    """
+    A function to compute the features of a shard of the sentences in a worker process.
+
+    :param shard: The shard of the sentences and the columns of the features to compute.
+    :return: The feature matrix of the shard.
+    """
+    sentences, columns = shard
+    return WORKEREXTRACTOR.transform(sentences, columns=columns)
+
+
+class FeatureExtractor:
+    """
+    Computes the corpus statistics used by the ten features once, so that the features of new sentences can be
+    computed without going over the training corpus again.
+    """
+
+    def __init__(self, raw=False, ngramwidth=0, capacity=None):
+        """
+        Feature extractor initialisation, the statistics are set by fit.
+
+        :param raw: Whether to emit the numeric statistic behind each feature instead of comparing it to the
+            threshold fitted on the corpus.
+        :param ngramwidth: The number of hashed character n-gram columns added after the ten features, none if 0.
+        :param capacity: The number of letters and words counted per language by a SpaceSaving summary, so the
+            memory of fit is bounded, and the distinct letters of the letter threshold are then those kept. They
+            are all counted exactly if None. It is at least 10, the number of top letters the features compare.
+        """
+        if capacity is not None and capacity < 10:
+            raise ValueError("The capacity must be at least 10, the number of top letters, not %d." % capacity)
+        self.raw = raw
+        self.ngramwidth = ngramwidth
+        self.capacity = capacity
+        self.approximation = None
+        self.lengththreshold = None
+        self.englishletters = None
+        self.dutchletters = None
+        self.englishset = None
+        self.dutchset = None
+        self.englishcommon = None
+        self.dutchcommon = None
+        self.uniquethreshold = None
+        self.letterthreshold = None
+        self.bigramthreshold = None
+        self.trigramthreshold = None
+        self.repeatingthreshold = None
+        self.totals = None
+        self.lettercounts = None
+        self.wordcounts = None
+
+    def fit(self, corpus):
+        """
+        A function to compute the statistics of the training corpus needed by each of the features.
+
+        :param corpus: The labelled training data, one "en|" or "nl|" prefixed sentence per line.
+        :return: The fitted feature extractor.
+        """
+        self.totals = None
+        self.update(corpus)
+        return self.finish()
+
+    def update(self, corpus):
+        """
+        A function to add a chunk of the training corpus to the running statistics, so that a corpus can be fit
+        chunk by chunk without holding all of it. Only counts, sums and the letter and word counters are kept.
+
+        :param corpus: A chunk of the labelled training data, one "en|" or "nl|" prefixed sentence per line.
+        :return: The feature extractor.
+        """
+        if self.totals is None:
+            # The running sums, with dutch in the first column and english in the second one.
+            self.totals = {i: np.zeros(2) for i in ('sentences', 'length', 'unique', 'bigram', 'trigram',
+                                                    'repeating')}
+            self.lettercounts = [self.counter(), self.counter()]
+            self.wordcounts = [self.counter(), self.counter()]
+
+        data = labelledcorpus(corpus)
+        wordlanguage = data.labels[data.wordsentence]
+        repeating = data.wordlength - data.distinctletters() >= 1
+        sentence, char, counts, first = data.charcounts()
+        self.totals['sentences'] += np.bincount(data.labels, minlength=2)
+        self.totals['length'] += np.bincount(wordlanguage, weights=data.wordlength, minlength=2)
+        self.totals['unique'] += np.bincount(data.labels[sentence], minlength=2)
+        self.totals['bigram'] += np.bincount(wordlanguage[data.wordlength == 2], minlength=2)
+        self.totals['trigram'] += np.bincount(wordlanguage[data.wordlength == 3], minlength=2)
+        self.totals['repeating'] += np.bincount(wordlanguage[repeating], minlength=2)
+
+        # The counters are updated in order of first occurence, so their ties break the same way as on the whole
+        # corpus at once.
+        wordkeys = data.wordkeys()
+        for language in (0, 1):
+            rows = np.flatnonzero((data.labels[data.sentenceof] == language) & (data.codes != 32))
+            self.lettercounts[language].update({chr(data.codes[rows[i]]): int(count)
+                                                for i, count in zip(*firstcounts(data.codes[rows]))})
+            words = np.flatnonzero(wordlanguage == language)
+            self.wordcounts[language].update({data.word(words[i]): int(count)
+                                              for i, count in zip(*firstcounts(wordkeys[words]))})
+        return self
+
+    def counter(self):
+        """
+        A function to get an empty counter of the letters or words of a language.
+
+        :return: A Counter, or a SpaceSaving summary if the capacity is set.
+        """
+        return Counter() if self.capacity is None else SpaceSaving(self.capacity)
+
+    def merge(self, other):
+        """
+        A function to add the running statistics of another extractor, updated on another part of the training
+        corpus, to the running statistics. Merging the parts in the order of the corpus gives the same statistics
+        as updating on the whole corpus, ties included.
+
+        :param other: The other feature extractor, not finished yet.
+        :return: The feature extractor.
+        """
+        if other.totals is None:
+            return self
+        if self.totals is None:
+            self.totals = {i: np.zeros(2) for i in other.totals}
+            self.lettercounts = [self.counter(), self.counter()]
+            self.wordcounts = [self.counter(), self.counter()]
+        for i in other.totals:
+            self.totals[i] += other.totals[i]
+        for language in (0, 1):
+            self.lettercounts[language].update(other.lettercounts[language])
+            self.wordcounts[language].update(other.wordcounts[language])
+        return self
+
+    def finish(self):
+        """
+        A function to compute the statistics needed by each of the features from the running statistics. The
+        running statistics are dropped afterwards, so they are not saved along with the model.
+
+        :return: The fitted feature extractor.
+        """
+        if self.capacity is not None:
+            # The largest overcount of the letters and words kept, and whether they are surely the top ones.
+            self.approximation = {
+                'letters': [[counter.error(10), counter.guaranteed(10)] for counter in self.lettercounts],
+                'words': [[counter.error(3), counter.guaranteed(3)] for counter in self.wordcounts],
+            }
+        sentences = self.totals['sentences']
+        letters = [[i[0] for i in counter.most_common(10)] for counter in self.lettercounts]
+        common = [[i[0] for i in counter.most_common(3)] for counter in self.wordcounts]
+        alpha = [len([i for i in counter if i.isalpha()]) for counter in self.lettercounts]
+        length, unique = self.totals['length'], self.totals['unique']
+        bigrams, trigrams, repeating = self.totals['bigram'], self.totals['trigram'], self.totals['repeating']
+
+        self.lengththreshold = (length[1] / (15 * sentences[1]) + length[0] / (15 * sentences[0])) / 2
+        self.dutchletters, self.englishletters = letters
+        self.englishset = set(self.englishletters) - set(self.dutchletters)
+        self.dutchset = set(self.dutchletters) - set(self.englishletters)
+        self.dutchcommon, self.englishcommon = common
+        self.uniquethreshold = (unique[1] / sentences[1] + unique[0] / sentences[0]) / 2
+        self.letterthreshold = (alpha[0] + alpha[1]) / 2
+        self.bigramthreshold = (bigrams[1] / sentences[1] + bigrams[0] / sentences[0]) / 2
+        self.trigramthreshold = (trigrams[1] / 15 + trigrams[0] / 15) / 2
+        self.repeatingthreshold = (repeating[1] / sentences[1] + repeating[0] / sentences[0]) / 2
+        self.totals = None
+        self.lettercounts = None
+        self.wordcounts = None
+        return self
+
+    def thresholds(self):
+        """
+        A function to get the threshold of each feature, a statistic above its threshold giving a feature of 0. The
+        features comparing the English and Dutch scores of a sentence have their difference as statistic.
+
+        :return: The list of the ten thresholds.
+        """
+        return [self.lengththreshold, 0, 0, 0, 0, self.uniquethreshold, self.letterthreshold, self.bigramthreshold,
+                self.trigramthreshold, self.repeatingthreshold]
+
+    def sentencestatistics(self, sentence):
+        """
+        A function to compute the statistics behind all ten features of a sentence. The statistics share a cache,
+        so the sentence is split into words and its characters are counted only once. It is the reference the
+        vectorized corpusstatistics is tested against.
+
+        :param sentence: The sentence without its label.
+        :return: The list of the ten statistics.
+        """
+        cache = {}
+        return [self.sentencestatistic(sentence, i, cache) for i in range(10)]
+
+    def sentencestatistic(self, sentence, column, cache=None):
+        """
+        A function to compute the statistic behind one of the ten features of a sentence, one column of
+        sentencestatistics.
+
+        :param sentence: The sentence without its label.
+        :param column: The column of the feature.
+        :param cache: A dictionary keeping the words and the character counts of the sentence between the calls.
+        :return: The statistic.
+        """
+        cache = {} if cache is None else cache
+        if column in (0, 4, 7, 8, 9) and 'words' not in cache:
+            cache['words'] = sentence.split()
+        if column in (1, 2, 3, 5, 6) and 'counter' not in cache:
+            cache['counter'] = Counter(sentence)
+        words, counter = cache.get('words'), cache.get('counter')
+
+        if column == 0:
+            return sum(len(j) for j in words) / 15
+        elif column == 1:
+            return sum((a != b) - (a != c) for a, b, c in
+                       zip(topletters(counter), self.englishletters, self.dutchletters))
+        elif column == 2:
+            return sum((a in self.englishset) - (a in self.dutchset) for a, b, c in
+                       zip(topletters(counter), self.englishletters, self.dutchletters))
+        elif column == 3:
+            return sum(counter[j] * ((j not in self.englishletters) - (j not in self.dutchletters)) for j in counter)
+        elif column == 4:
+            return sum(1 if j in self.englishcommon else -1 if j in self.dutchcommon else 0 for j in words)
+        elif column == 5:
+            return len(counter)
+        elif column == 6:
+            return len(counter) - (' ' in counter)
+        elif column == 7:
+            return sum(len(j) == 2 for j in words)
+        elif column == 8:
+            return sum(len(j) == 3 for j in words)
+        return sum(len(j) - len(set(j)) >= 1 for j in words)
+
+    def lazyfeatures(self, sentence):
+        """
+        A function to get the features of a sentence one at a time, each of them being computed the first time it
+        is asked for, so that classifying the sentence down a tree computes only the features its path tests.
+
+        :param sentence: The sentence, with or without its language label.
+        :return: A function of a column returning the feature of the sentence in that column.
+        """
+        sentence = striplabel(sentence)
+        thresholds = self.thresholds()
+        cache = {}
+
+        def feature(column):
+            if column not in cache:
+                if column >= len(thresholds):
+                    if 'ngrams' not in cache:
+                        cache['ngrams'] = NgramHasher(self.ngramwidth, binary=not self.raw).transform([sentence])[0]
+                    cache[column] = cache['ngrams'][column - len(thresholds)]
+                else:
+                    value = self.sentencestatistic(sentence, column, cache)
+                    cache[column] = value if self.raw else 0 if value > thresholds[column] else 1
+            return cache[column]
+
+        return feature
+
+    def corpusstatistics(self, corpus, columns=None):
+        """
+        A function to compute the statistics behind all ten features for every sentence of a corpus at once.
+
+        :param corpus: The Corpus of the sentences.
+        :param columns: The columns of the statistics to compute, all of them if None, the others being left at 0.
+        :return: The statistics matrix with one row per sentence.
+        """
+        wanted = set(range(10)) if columns is None else set(int(i) for i in columns)
+        n = corpus.size
+        X = np.zeros((n, 10), dtype=np.float64)
+        englishletters = np.asarray([ord(i) for i in self.englishletters], dtype=np.uint32)
+        dutchletters = np.asarray([ord(i) for i in self.dutchletters], dtype=np.uint32)
+        englishset = np.asarray([ord(i) for i in self.englishset], dtype=np.uint32)
+        dutchset = np.asarray([ord(i) for i in self.dutchset], dtype=np.uint32)
+
+        if 0 in wanted:
+            X[:, 0] = np.bincount(corpus.wordsentence, weights=corpus.wordlength, minlength=n) / 15
+        if wanted & {1, 2, 5, 6}:
+            self.letterstatistics(corpus, X, englishletters, dutchletters, englishset, dutchset, wanted)
+        if 3 in wanted:
+            X[:, 3] = np.bincount(corpus.sentenceof, weights=~np.isin(corpus.codes, englishletters), minlength=n) - \
+                np.bincount(corpus.sentenceof, weights=~np.isin(corpus.codes, dutchletters), minlength=n)
+        if 4 in wanted:
+            wordkeys = corpus.wordkeys()
+            englishwords = np.isin(wordkeys, Corpus(self.englishcommon).wordkeys())
+            dutchwords = np.isin(wordkeys, Corpus(self.dutchcommon).wordkeys()) & ~englishwords
+            X[:, 4] = np.bincount(corpus.wordsentence, weights=englishwords, minlength=n) - \
+                np.bincount(corpus.wordsentence, weights=dutchwords, minlength=n)
+        if 7 in wanted:
+            X[:, 7] = np.bincount(corpus.wordsentence[corpus.wordlength == 2], minlength=n)
+        if 8 in wanted:
+            X[:, 8] = np.bincount(corpus.wordsentence[corpus.wordlength == 3], minlength=n)
+        if 9 in wanted:
+            repeating = corpus.wordlength - corpus.distinctletters() >= 1
+            X[:, 9] = np.bincount(corpus.wordsentence[repeating], minlength=n)
+        X[:, sorted(set(range(10)) - wanted)] = 0
+        return X
+
+    def letterstatistics(self, corpus, X, englishletters, dutchletters, englishset, dutchset, wanted=(1, 2)):
+        """
+        A function to compute the statistics of the columns 1, 2, 5 and 6, which come from the distinct characters
+        of each sentence, for every sentence of a corpus at once.
+
+        :param corpus: The Corpus of the sentences.
+        :param X: The statistics matrix to fill in.
+        :param englishletters: The code points of the top english letters.
+        :param dutchletters: The code points of the top dutch letters.
+        :param englishset: The code points of the top english letters which are not top dutch letters.
+        :param dutchset: The code points of the top dutch letters which are not top english letters.
+        :param wanted: The columns wanted, the top letters are not ranked if neither 1 nor 2 is.
+        """
+        n = corpus.size
+        # The top letters of each sentence are its distinct letters sorted by count and then by first occurence,
+        # and rank is the place of each letter in its sentence.
+        sentence, char, counts, first = corpus.charcounts()
+        X[:, 5] = np.bincount(sentence, minlength=n)
+        letter = char != 32
+        X[:, 6] = np.bincount(sentence[letter], minlength=n)
+        if 1 not in wanted and 2 not in wanted:
+            return
+        sentence, char, counts, first = sentence[letter], char[letter], counts[letter], first[letter]
+        order = np.lexsort((first, -counts, sentence))
+        sentence, char = sentence[order], char[order]
+        rank = np.arange(len(sentence)) - np.searchsorted(sentence, sentence)
+        top = rank < min(10, len(englishletters), len(dutchletters))
+        sentence, char, rank = sentence[top], char[top], rank[top]
+        X[:, 1] = np.bincount(sentence, weights=char != englishletters[rank], minlength=n) - \
+            np.bincount(sentence, weights=char != dutchletters[rank], minlength=n)
+        X[:, 2] = np.bincount(sentence, weights=np.isin(char, englishset), minlength=n) - \
+            np.bincount(sentence, weights=np.isin(char, dutchset), minlength=n)
+
+    def transform(self, sentences, workers=1, columns=None):
+        """
+        A function to compute the ten features for each of the sentences using the fitted statistics. With more
+        than one worker, the sentences are split into contiguous shards which a pool of processes transforms, the
+        extractor being sent to each process once, and the rows of the shards are put back together in order.
+
+        :param sentences: The sentences, with or without their language label.
+        :param workers: The number of processes to compute the features with.
+        :param columns: The columns of the features to compute, all of them if None, the others being left at 0.
+        :return: The feature matrix with one row per sentence, holding the statistics if the extractor is raw.
+        """
+        if workers > 1 and len(sentences) > workers:
+            # A few shards per worker even out the shards with longer sentences.
+            shardsize = -(-len(sentences) // (4 * workers))
+            shards = [sentences[i:i + shardsize] for i in range(0, len(sentences), shardsize)]
+            with multiprocessing.Pool(workers, initializer=initworker, initargs=(self,)) as pool:
+                return np.concatenate(pool.map(transformshard, [(i, columns) for i in shards]))
+
+        sentences = [striplabel(i) for i in sentences]
+        X = self.corpusstatistics(Corpus(sentences), columns)
+        if not self.raw:
+            X = (X <= np.asarray(self.thresholds())).astype(np.int64)
+            if columns is not None:
+                X[:, sorted(set(range(10)) - set(int(i) for i in columns))] = 0
+        if self.ngramwidth:
+            if columns is None or max(columns, default=-1) >= 10:
+                # The raw extractor counts the n-grams, the boolean one only tells whether they occur.
+                ngrams = NgramHasher(self.ngramwidth, binary=not self.raw).transform(sentences)
+            else:
+                ngrams = np.zeros((len(sentences), self.ngramwidth), dtype=np.int64)
+            X = np.column_stack((X, ngrams))
+        return X
+
+
+class SpaceSaving:
+
+    def __init__(self, capacity=1000):
+        """
+        Space-Saving summary initialisation. It counts at most capacity items in a stream of weighted items. An
+        item arriving when the summary is full takes the place of the item with the smallest count and inherits
+        that count as its possible overcount, so every count is at most the total weight over capacity too high
+        and any item more frequent than that is kept.
+
+        :param capacity: The number of items counted.
+        """
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # A heap of the counts, with stale entries skipped when they come out.
+        self.heap = []
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def update(self, items):
+        """
+        A function to add weighted items to the summary, in their order, like Counter.update does.
+
+        :param items: A mapping of the items to their weights, or another SpaceSaving summary, whose overcounts are
+            added to those of its items.
+        """
+        errors = items.errors if isinstance(items, SpaceSaving) else {}
+        for item, count in (items.counts if isinstance(items, SpaceSaving) else items).items():
+            error = errors.get(item, 0)
+            self.total += count
+            if item in self.counts:
+                self.counts[item] += count
+                self.errors[item] += error
+            elif len(self.counts) < self.capacity:
+                self.counts[item] = count
+                self.errors[item] = error
+            else:
+                smallest, old = self.popsmallest()
+                del self.counts[old], self.errors[old]
+                self.counts[item] = smallest + count
+                self.errors[item] = smallest + error
+            heapq.heappush(self.heap, (self.counts[item], len(self.heap), item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, i, item) for i, (item, count) in enumerate(self.counts.items())]
+            heapq.heapify(self.heap)
+
+    def popsmallest(self):
+        """
+        A function to take the item with the smallest count off the heap.
+
+        :return: The smallest count and its item.
+        """
+        while True:
+            count, _, item = heapq.heappop(self.heap)
+            if self.counts.get(item) == count:
+                return count, item
+
+    def most_common(self, n):
+        """
+        A function to get the items with the largest counts, ties going to the item counted first like in Counter.
+
+        :param n: The number of items.
+        :return: The items and their counts, largest first.
+        """
+        return sorted(self.counts.items(), key=lambda i: i[1], reverse=True)[:n]
+
+    def error(self, n):
+        """
+        A function to get the approximation error of the top items.
+
+        :param n: The number of top items.
+        :return: The largest overcount of the n items with the largest counts.
+        """
+        return max([self.errors[i] for i, _ in self.most_common(n)], default=0)
+
+    def guaranteed(self, n):
+        """
+        A function to tell whether the n items with the largest counts are surely the n most frequent items, which
+        is the case when each of them is more frequent than the largest count left out.
+
+        :param n: The number of top items.
+        :return: Whether the top items are exact.
+        """
+        top = self.most_common(n + 1)
+        if len(top) <= n:
+            return len(self.counts) < self.capacity or all(self.errors[i] == 0 for i, _ in top)
+        return min(count - self.errors[i] for i, count in top[:n]) >= top[n][1]
+
+
+class NgramHasher:
+    """
+    Hashes the character n-grams of sentences into a fixed number of columns, so the memory used does not depend on
+    the number of distinct n-grams.
+    """
+
+    def __init__(self, width=256, nmin=1, nmax=4, binary=True):
+        """
+        N-gram hasher initialisation.
+
+        :param width: The number of columns the n-grams are hashed into.
+        :param nmin: The smallest n-gram length.
+        :param nmax: The largest n-gram length.
+        :param binary: Whether a column tells if any of its n-grams occurs instead of counting them.
+        """
+        self.width = width
+        self.nmin = nmin
+        self.nmax = nmax
+        self.binary = binary
+
+    def transform(self, sentences):
+        """
+        A function to compute the hashed n-gram columns of all the sentences at once. The sentences are loaded into
+        one Corpus, the hash of every n-gram of every length is computed over all its code points at once, and the
+        n-grams crossing from one sentence to the next are dropped.
+
+        :param sentences: The sentences without their label.
+        :return: The hashed n-gram matrix with one row per sentence.
+        """
+        X = np.zeros((len(sentences), self.width), dtype=np.int64)
+        if not sentences:
+            return X
+        corpus = Corpus([i.lower() for i in sentences])
+        codes = corpus.codes.astype(np.uint64)
+        sentenceof = corpus.sentenceof
+        ends = corpus.offsets[1:]
+
+        hashes = np.zeros(len(codes), dtype=np.uint64)
+        for n in range(1, self.nmax + 1):
+            count = len(codes) - n + 1
+            if count <= 0:
+                break
+            hashes = hashes[:count] * np.uint64(1000003) + codes[n - 1:]
+            if n < self.nmin:
+                continue
+            # An n-gram starting at i belongs to its sentence only if it ends before the sentence does.
+            inside = np.arange(count) + n <= ends[sentenceof[:count]]
+            mixed = (hashes[inside] + np.uint64(n)) * np.uint64(0x9E3779B97F4A7C15)
+            mixed ^= mixed >> np.uint64(29)
+            columns = (mixed % np.uint64(self.width)).astype(np.int64)
+            X += np.bincount(sentenceof[:count][inside] * self.width + columns,
+                             minlength=len(sentences) * self.width).reshape(len(sentences), self.width)
+        if self.binary:
+            X = (X > 0).astype(np.int64)
+        return X
@@ -0,0 +1,311 @@
+import io
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from classifiers import *
+from features import *
+import utils
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="module")
+def training():
+    return utils.traininginput(os.path.join(HERE, 'train.dat'))
+
+
+@pytest.fixture(scope="module")
+def testing():
+    return utils.testinput(os.path.join(HERE, 'test.dat'))
+
+
+def test_transform_matches_feature_functions(training):
+    english, dutch, data = training
+    functions = [lengthofwords, freqoflettersinsentence, uncommontopletters, worduniqueness, tfidf,
+                 uniquewordsinsentence, uniquelettersinasentence, bigram, trigram, wordswithrepeatingletters]
+    expected = np.column_stack([function(english, dutch, data) for function in functions])
+    assert (FeatureExtractor().fit(data).transform(data) == expected).all()
+
+
+def test_corpusstatistics_matches_sentencestatistics(training, testing):
+    extractor = FeatureExtractor().fit(training[2])
+    sentences = [striplabel(i) for i in training[2]] + testing + ['', ' ', 'a', '  two  spaces ', 'ééé ÿ']
+    expected = np.asarray([extractor.sentencestatistics(i) for i in sentences], dtype=np.float64)
+    assert (extractor.corpusstatistics(Corpus(sentences)) == expected).all()
+
+
+@pytest.mark.parametrize("chunksize", [1, 7, 64])
+def test_chunked_update_matches_fit(training, chunksize):
+    data = training[2]
+    fitted = FeatureExtractor().fit(data)
+    extractor = FeatureExtractor()
+    for i in range(0, len(data), chunksize):
+        extractor.update(data[i:i + chunksize])
+    extractor.finish()
+    assert extractor.thresholds() == fitted.thresholds()
+    assert extractor.englishletters == fitted.englishletters
+    assert extractor.dutchletters == fitted.dutchletters
+    assert extractor.englishcommon == fitted.englishcommon
+    assert extractor.dutchcommon == fitted.dutchcommon
+
+
+def compiledarrays(model):
+    return [model.feature, model.value, model.left, model.right, model.leafclass, model.leafcounts]
+
+
+def assertsametree(a, b):
+    for i, j in zip(compiledarrays(a), compiledarrays(b)):
+        assert i.shape == j.shape
+        if i.dtype.kind == 'f' and i is a.leafcounts:
+            # Weighted leaf counts are sums of floats, which blocks of rows add up in another order.
+            assert np.allclose(i, j, rtol=1e-12, atol=0)
+        else:
+            assert (i == j).all()
+
+
+def assertsameensemble(a, b):
+    assert len(a.models) == len(b.models) and a.modelweight == b.modelweight
+    for i, j in zip(a.models, b.models):
+        assertsametree(i, j)
+
+
+@pytest.fixture(scope="module")
+def matrix(training):
+    data = training[2]
+    X = FeatureExtractor(ngramwidth=16).fit(data).transform(data)
+    y = np.asarray([1 if i[:3] == 'en|' else 0 for i in data])
+    return np.column_stack((X, y))
+
+
+@pytest.mark.parametrize("size", [1, 63, 64, 65, None])
+def test_packed_tree_matches_unpacked(matrix, size):
+    X = matrix[:size]
+    packed = BitMatrix(X)
+    assert (packed.unpack() == X).all()
+    unpacked = DecisionTree(X, X[:, -1])
+    unpacked.rootnode(unpacked.build_tree(X))
+    tree = DecisionTree(packed, X[:, -1])
+    tree.rootnode(tree.build_tree(packed))
+    assertsametree(tree, unpacked)
+
+
+@pytest.mark.parametrize("raw", [False, True])
+def test_sharded_tree_matches_concatenated(tmp_path, raw):
+    with open(os.path.join(HERE, 'train.dat'), encoding="utf8") as f:
+        lines = f.readlines()
+    shards = []
+    for i, (start, stop) in enumerate([(0, 13), (13, 13), (13, 60), (60, len(lines))]):
+        shards.append(str(tmp_path / ('shard%d.dat' % i)))
+        with open(shards[-1], 'w', encoding="utf8") as f:
+            f.writelines(lines[start:stop])
+    utils.train(os.path.join(HERE, 'train.dat'), str(tmp_path / 'full'), 'dt', raw=raw, ngramwidth=16)
+    utils.trainsharded(shards, str(tmp_path / 'sharded'), raw=raw, ngramwidth=16, chunksize=7)
+    full, sharded = utils.loadmodel(str(tmp_path / 'full')), utils.loadmodel(str(tmp_path / 'sharded'))
+    assertsametree(sharded, full)
+    assert sharded.extractor.thresholds() == full.extractor.thresholds()
+
+
+@pytest.mark.parametrize("classifier, raw", [('dt', False), ('dt', True), ('ada', False)])
+def test_lazy_prediction_matches_batch(tmp_path, testing, classifier, raw):
+    utils.train(os.path.join(HERE, 'train.dat'), str(tmp_path / 'model'), classifier, raw=raw)
+    model = utils.loadmodel(str(tmp_path / 'model'))
+    lazy = utils.classifysentences(model, testing, lazy=True)
+    assert (lazy == utils.classifysentences(model, testing)).all()
+
+
+@pytest.mark.parametrize("classifier, raw, margin", [('dt', False, None), ('dt', True, None), ('ada', False, None),
+                                                     ('gb', True, None), ('samme', False, None), ('dt', False, 0.8)])
+def test_compact_prediction_matches_pickle(tmp_path, testing, classifier, raw, margin):
+    # The boosted learning types resample the rows at random, so the same trained model is stored in both formats.
+    utils.train(os.path.join(HERE, 'train.dat'), str(tmp_path / 'pickled'), classifier, raw=raw, ngramwidth=16,
+                margin=margin)
+    pickled = utils.loadmodel(str(tmp_path / 'pickled'))
+    utils.savemodel(pickled, str(tmp_path / 'compact'), compact=True)
+    assert os.path.exists(str(tmp_path / 'compact.npz'))
+    compact = utils.loadmodel(str(tmp_path / 'compact'))
+    assert (utils.classifysentences(compact, testing) == utils.classifysentences(pickled, testing)).all()
+
+
+@pytest.mark.parametrize("first, second", [(True, False), (False, True)])
+def test_saved_model_replaces_other_format(tmp_path, first, second):
+    name = str(tmp_path / 'model')
+    utils.train(os.path.join(HERE, 'train.dat'), name, 'gb', compact=first)
+    utils.train(os.path.join(HERE, 'train.dat'), name, 'dt', compact=second)
+    assert isinstance(utils.loadmodel(name), DecisionTree)
+    assert os.path.exists(name + ('.npz' if second else '.obj'))
+    assert not os.path.exists(name + ('.obj' if second else '.npz'))
+
+
+def assertsameextractor(a, b):
+    assert a.thresholds() == b.thresholds()
+    assert (a.raw, a.ngramwidth) == (b.raw, b.ngramwidth)
+    assert (a.englishletters, a.dutchletters) == (b.englishletters, b.dutchletters)
+    assert (a.englishcommon, a.dutchcommon) == (b.englishcommon, b.dutchcommon)
+
+
+@pytest.fixture
+def countreads(monkeypatch):
+    reads = []
+
+    def traininginput(input_file):
+        reads.append(input_file)
+        return original(input_file)
+
+    original = utils.traininginput
+    monkeypatch.setattr(utils, 'traininginput', traininginput)
+    return reads
+
+
+@pytest.mark.parametrize("raw", [False, True])
+def test_cached_features_match_uncached(tmp_path, countreads, raw):
+    file = os.path.join(HERE, 'train.dat')
+    extractor, X_train, y = utils.trainingfeatures(file, raw, 16)
+    written = utils.trainingfeatures(file, raw, 16, str(tmp_path))
+    cached = utils.trainingfeatures(file, raw, 16, str(tmp_path))
+    # The uncached run and the run writing the cache read the file, the last run is a hit.
+    assert len(countreads) == 2
+    for features in (written, cached):
+        assertsameextractor(features[0], extractor)
+        assert features[1].dtype == X_train.dtype and (features[1] == X_train).all()
+        assert (features[2] == y).all()
+
+
+def test_cache_misses_on_any_change(tmp_path, countreads, monkeypatch):
+    file = str(tmp_path / 'train.dat')
+    with open(os.path.join(HERE, 'train.dat'), encoding="utf8") as source, open(file, 'w', encoding="utf8") as f:
+        f.write(source.read())
+    cachedir = str(tmp_path / 'cache')
+    _, X_train, _ = utils.trainingfeatures(file, False, 0, cachedir)
+    rows = len(X_train)
+    utils.trainingfeatures(file, False, 0, cachedir)
+    assert len(countreads) == 1
+
+    utils.trainingfeatures(file, True, 0, cachedir)
+    assert len(countreads) == 2
+    utils.trainingfeatures(file, False, 16, cachedir)
+    assert len(countreads) == 3
+    with open(file, 'a', encoding="utf8") as f:
+        f.write('en|one more line\n')
+    _, X_train, _ = utils.trainingfeatures(file, False, 0, cachedir)
+    assert len(countreads) == 4 and len(X_train) == rows + 1
+    monkeypatch.setattr(utils, 'FEATUREVERSION', utils.FEATUREVERSION + 1)
+    utils.trainingfeatures(file, False, 0, cachedir)
+    assert len(countreads) == 5
+
+
+@pytest.fixture(scope="module")
+def streammodel(tmp_path_factory, testing):
+    name = str(tmp_path_factory.mktemp('stream') / 'model')
+    utils.train(os.path.join(HERE, 'train.dat'), name, 'dt')
+    answers = utils.classifysentences(utils.loadmodel(name), testing)
+    return name, ["en" if i == 1 else "nl" for i in answers]
+
+
+@pytest.mark.parametrize("batchsize", [1, 3, 1000])
+@pytest.mark.parametrize("lineids", [False, True])
+def test_predictstream_matches_predict(streammodel, batchsize, lineids):
+    name, expected = streammodel
+    output = io.BytesIO()
+    count = utils.predictstream(name, os.path.join(HERE, 'test.dat'), batchsize, output, lineids)
+    assert count == len(expected)
+    if lineids:
+        expected = ['%d\t%s' % (i, j) for i, j in enumerate(expected)]
+    assert output.getvalue().decode().splitlines() == expected
+
+
+def test_predictstream_keeps_output_open_after_error(streammodel, monkeypatch):
+    name, expected = streammodel
+    classifysentences = utils.classifysentences
+    batches = []
+
+    def failing(model, batch, **kwargs):
+        batches.append(batch)
+        if len(batches) == 2:
+            raise RuntimeError("failed batch")
+        return classifysentences(model, batch, **kwargs)
+
+    monkeypatch.setattr(utils, 'classifysentences', failing)
+    output = io.BytesIO()
+    with pytest.raises(RuntimeError):
+        utils.predictstream(name, os.path.join(HERE, 'test.dat'), 3, output)
+    assert not output.closed
+    assert output.getvalue().decode().splitlines() == expected[:3]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_spacesaving_bounds(seed):
+    rng = np.random.default_rng(seed)
+    capacity = int(rng.integers(1, 30))
+    summary, true = SpaceSaving(capacity), Counter()
+    for _ in range(int(rng.integers(1, 40))):
+        # A skewed stream, so some items are frequent and many are rare.
+        items = rng.zipf(1.5, size=int(rng.integers(1, 50))) % 200
+        weights = Counter(items.tolist())
+        summary.update(weights)
+        true.update(weights)
+    assert len(summary) <= capacity and summary.total == sum(true.values())
+    for item, count in summary.counts.items():
+        assert count - summary.errors[item] <= true[item] <= count
+    for n in (1, 3, 10):
+        assert summary.error(n) == max([summary.errors[i] for i, _ in summary.most_common(n)], default=0)
+        if summary.guaranteed(n):
+            top = [i for i, _ in summary.most_common(n)]
+            assert min(true[i] for i in top) >= max([true[i] for i in true if i not in top], default=0)
+
+
+def test_capacity_above_vocabulary_matches_exact_fit(training):
+    data = training[2]
+    fitted = FeatureExtractor().fit(data)
+    extractor = FeatureExtractor(capacity=1 << 20)
+    extractor.update(data)
+    extractor.finish()
+    assertsameextractor(extractor, fitted)
+    assert all(error == 0 and guaranteed for kind in extractor.approximation.values()
+               for error, guaranteed in kind)
+    assert (extractor.transform(data) == fitted.transform(data)).all()
+
+
+def test_capacity_below_top_letters_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        FeatureExtractor(capacity=3)
+    with pytest.raises(ValueError):
+        utils.trainstream(os.path.join(HERE, 'train.dat'), str(tmp_path / 'model'), 'dt', capacity=9)
+
+
+@pytest.fixture(scope="module")
+def rawmatrix(training):
+    data = training[2]
+    X = FeatureExtractor(raw=True).fit(data).transform(data)
+    y = np.asarray([1 if i[:3] == 'en|' else 0 for i in data])
+    return np.column_stack((X, y))
+
+
+@pytest.mark.parametrize("classifier", ['dt', 'samme'])
+@pytest.mark.parametrize("raw", [False, True])
+def test_blockwise_tree_matches_in_memory(matrix, rawmatrix, classifier, raw):
+    X = rawmatrix if raw else matrix
+    maxbins = 64 if raw else None
+    # 7 does not divide the number of rows, so the last block is a short one.
+    assert len(X) % 7 != 0
+    blockwise = utils.fitmodel(X, X[:, -1], classifier, maxbins, blocksize=7)
+    inmemory = utils.fitmodel(X, X[:, -1], classifier, maxbins)
+    if classifier == 'dt':
+        assertsametree(blockwise, inmemory)
+    else:
+        assertsameensemble(blockwise, inmemory)
+
+
+@pytest.mark.parametrize("raw", [False, True])
+def test_forest_does_not_depend_on_workers(matrix, rawmatrix, raw):
+    X = rawmatrix if raw else matrix
+    forests = []
+    for workers in (1, 3):
+        forest = RandomForest(X, X[:, -1], 10, maxbins=64 if raw else None, maxfeatures=(X.shape[1] - 1) // 2,
+                              workers=workers)
+        forest.train(X)
+        forests.append(forest)
+    assertsameensemble(*forests)
+    assert (forests[0].predict_batch(X[:, :-1]) == forests[1].predict_batch(X[:, :-1])).all()
@@ -1,6 +1,19 @@
 from features import *
 from classifiers import *
+import contextlib
+import hashlib
+import io
+import itertools
+import multiprocessing
+import os
 import pickle
+import sys
+
+# The version of the compact model format written by savecompact.
+MODELFORMAT = 1
+
+# The learning types whose trees read the training dataset a block of rows at a time, so that it can stay on disk.
+BLOCKWISE = ('dt', 'samme')
 
 
 def traininginput(input_file):
@@ -12,9 +25,7 @@ def traininginput(input_file):
     """
     data = open(input_file, encoding="utf8").read().splitlines()
     englishdata, dutchdata = [], []
-    maindata = []
     for i in data:
-        maindata.append(i.lower())
         if i.startswith("nl|"):
             dutchdata.append(i[3:].lower())
         elif i.startswith("en|"):
@@ -32,7 +43,8 @@ def testinput(test_file):
     return open(test_file).read().splitlines()
 
 
-def train(input_file, model_output, classifier):
+def train(input_file, model_output, classifier, raw=False, maxbins=64, ngramwidth=0, compact=False, cachedir=None,
+          workers=1, margin=None):
     """
     Train the dataset based on the input parameters and also get the feautures from the training
     document corpus dataset.
@@ -40,33 +52,74 @@ def train(input_file, model_output, classifier):
     :param input_file: The input training file.
     :param model_output: The output file to store the model.
     :param classifier: The name of the classifier to use.
+    :param raw: Whether to train on the numeric statistics behind the features instead of the boolean features.
+    :param maxbins: The number of quantile bins the trees pick their thresholds from when raw is set.
+    :param ngramwidth: The number of hashed character n-gram columns added to the features, none if 0.
+    :param compact: Whether to store the model in the compact format instead of pickling it.
+    :param cachedir: The directory to cache the feature matrix in, no cache if None.
+    :param workers: The number of processes to compute the features and to grow the trees of a forest with.
+    :param margin: The leaf margin above which a first stage tree on the cheap features answers in front of the
+        classifier, no first stage if None.
     """
-    global english, dutch, tree, dt, ada
-
-    english, dutch, data = traininginput(input_file)
-
-    feature1 = np.asarray(lengthofwords(english, dutch, data))
-
-    feature2 = np.asarray(freqoflettersinsentence(english, dutch, data))
-
-    feature3 = np.asarray(uncommontopletters(english, dutch, data))
-
-    feature4 = np.asarray(worduniqueness(english, dutch, data))
-
-    feature5 = np.asarray(tfidf(english, dutch, data))
+    extractor, X_train, y = trainingfeatures(input_file, raw, ngramwidth, cachedir, workers)
+    if classifier == 'dt' and not raw:
+        # The boolean features and labels are packed into a bit each, as only the decision tree counts its splits on
+        # the packed bits.
+        X_train = BitMatrix(X_train)
+    model = fitmodel(X_train, y, classifier, maxbins if raw else None, workers=workers)
+    model.extractor = extractor
+    if not raw:
+        model.lookup = LookupTable(model, X_train.shape[1] - 1)
+    if margin is not None:
+        model = fitcascade(X_train, model, margin, maxbins if raw else None)
+    savemodel(model, model_output, compact)
+
+
+def fitcascade(X_train, model, margin, maxbins=None):
+    """
+    A function to put a first stage decision tree on the cheap features in front of a trained model.
 
-    feature6 = np.asarray(uniquewordsinsentence(english, dutch, data))
+    :param X_train: The training dataset, with the labels in the last column, as an array or a BitMatrix.
+    :param model: The trained model.
+    :param margin: The smallest margin of a leaf of the first stage for it to answer.
+    :param maxbins: The number of quantile bins the first stage picks its thresholds from, for real valued features.
+    :return: The cascade of the first stage and the model.
+    """
+    X = X_train.unpack() if isinstance(X_train, BitMatrix) else np.array(X_train)
+    # The other features are set to 0, so the first stage never splits on them and keeps the columns of the model.
+    X[:, [i for i in range(X.shape[1] - 1) if i not in CHEAPFEATURES]] = 0
+    first = DecisionTree(X, X[:, -1], maxdepth=3, maxbins=maxbins)
+    first.rootnode(first.build_tree(X))
+    cascade = Cascade(first, model, margin)
+    cascade.extractor = model.extractor
+    return cascade
 
-    feature7 = np.asarray(uniquelettersinasentence(english, dutch, data))
 
-    feature8 = np.asarray(bigram(english, dutch, data))
+def trainingfeatures(input_file, raw=False, ngramwidth=0, cachedir=None, workers=1):
+    """
+    A function to fit the feature extractor on the training file and compute the feature matrix. With a cache
+    directory, the matrix and the extractor are stored there under a key made of the contents of the training file
+    and the configuration and version of the features, and are loaded back when the key matches.
 
-    feature9 = np.asarray(trigram(english, dutch, data))
+    :param input_file: The input training file.
+    :param raw: Whether to compute the numeric statistics behind the features instead of the boolean features.
+    :param ngramwidth: The number of hashed character n-gram columns added to the features, none if 0.
+    :param cachedir: The directory to cache the feature matrix in, no cache if None.
+    :param workers: The number of processes to compute the features with.
+    :return: The fitted extractor, the training dataset with the labels in the last column and the labels.
+    """
+    if cachedir is not None:
+        path = os.path.join(cachedir, cachekey(input_file, raw, ngramwidth))
+        if os.path.exists(path+'.npy') and os.path.exists(path+'.npz'):
+            X_train = np.load(path+'.npy', allow_pickle=False)
+            with np.load(path+'.npz', allow_pickle=False) as arrays:
+                extractor = loadextractor(arrays)
+            return extractor, X_train, X_train[:, -1].astype(np.int64)
 
-    feature10 = np.asarray(wordswithrepeatingletters(english, dutch, data))
+    english, dutch, data = traininginput(input_file)
 
-    X_train = np.column_stack(
-        (feature1, feature2, feature3, feature4, feature5, feature6, feature7, feature8, feature9, feature10))
+    extractor = FeatureExtractor(raw=raw, ngramwidth=ngramwidth).fit(data)
+    X_train = extractor.transform(data, workers)
 
     y = []
     for i in data:
@@ -78,71 +131,627 @@ def train(input_file, model_output, classifier):
     y = np.asarray(y)
     X_train = np.column_stack((X_train, y))
 
-    if classifier == 'dt':
-        tree = DecisionTree(X_train, y, maxdepth=5)
-        dt = tree.build_tree(X_train)
-        tree.rootnode(dt)
-        file = open(model_output+'.obj','wb')
-        pickle.dump(tree,file)
+    if cachedir is not None:
+        # The files are written under a temporary name first, so a run never reads a half written cache.
+        os.makedirs(cachedir, exist_ok=True)
+        with open(path+'.npy.tmp', 'wb') as file:
+            np.save(file, X_train)
+        with open(path+'.npz.tmp', 'wb') as file:
+            np.savez(file, **extractorarrays(extractor))
+        os.replace(path+'.npy.tmp', path+'.npy')
+        os.replace(path+'.npz.tmp', path+'.npz')
+    return extractor, X_train, y
+
+
+def cachekey(input_file, raw=False, ngramwidth=0):
+    """
+    A function to get the key of the feature matrix of a training file in the cache.
+
+    :param input_file: The input training file.
+    :param raw: Whether the features are the numeric statistics.
+    :param ngramwidth: The number of hashed character n-gram columns.
+    :return: The key, a hexadecimal digest of the file contents and of the feature configuration and version.
+    """
+    digest = hashlib.sha256()
+    with open(input_file, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    digest.update(repr((FEATUREVERSION, bool(raw), int(ngramwidth))).encode())
+    return digest.hexdigest()
 
 
+def chunkrows(extractor, chunk):
+    """
+    A function to compute the feature rows of a chunk of lines of the training dataset, the lines without a label
+    being left out.
+
+    :param extractor: The fitted feature extractor.
+    :param chunk: The lines.
+    :return: The feature rows, with the labels in the last column.
+    """
+    chunk = [i for i in chunk if i[:3] in ('en|', 'nl|')]
+    y = np.asarray([1 if i[:3] == 'en|' else 0 for i in chunk], dtype=np.int64)
+    # The boolean features and labels fit in a byte each.
+    return np.column_stack((extractor.transform(chunk), y)).astype(np.float64 if extractor.raw else np.uint8)
+
+
+def readchunks(input_file, chunksize=10000):
+    """
+    A function to read the training dataset from the file a chunk of lines at a time.
+
+    :param input_file: The name of the input file.
+    :param chunksize: The number of lines in each chunk.
+    :return: A generator of the chunks, as lists of lines.
+    """
+    with open(input_file, encoding="utf8") as file:
+        chunk = []
+        for line in file:
+            chunk.append(line.rstrip('\r\n'))
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def trainstream(input_file, model_output, classifier, chunksize=10000, raw=False, maxbins=64, ngramwidth=0,
+                compact=False, memmap=None, capacity=None):
+    """
+    Train the dataset like train does, but reading the training file in chunks. A first pass over the file
+    accumulates the corpus statistics of the features and a second pass computes the feature rows of each chunk, so
+    only the feature rows and a single chunk of text are held at a time.
+
+    :param input_file: The input training file.
+    :param model_output: The output file to store the model.
+    :param classifier: The name of the classifier to use.
+    :param chunksize: The number of lines read at a time.
+    :param raw: Whether to train on the numeric statistics behind the features instead of the boolean features.
+    :param maxbins: The number of quantile bins the trees pick their thresholds from when raw is set.
+    :param ngramwidth: The number of hashed character n-gram columns added to the features, none if 0.
+    :param compact: Whether to store the model in the compact format instead of pickling it.
+    :param memmap: The .npy file to write the feature rows to, the trees then being built from it on disk chunksize
+        rows at a time, for the learning types of BLOCKWISE only. The feature rows are held in memory if None.
+    :param capacity: The number of letters and words per language the first pass counts, all of them if None. The
+        approximation of the counts is printed and kept in the approximation of the extractor of the model.
+    """
+    if memmap is not None and classifier not in BLOCKWISE:
+        raise ValueError("The learning type %s does not train from a memory map." % classifier)
+    extractor = FeatureExtractor(raw=raw, ngramwidth=ngramwidth, capacity=capacity)
+    size = 0
+    for chunk in readchunks(input_file, chunksize):
+        extractor.update(chunk)
+        size += sum(1 for i in chunk if i[:3] in ('en|', 'nl|'))
+    extractor.finish()
+    if extractor.approximation is not None:
+        for kind, counts in (('letters', 10), ('words', 3)):
+            for language, (error, guaranteed) in zip(('nl', 'en'), extractor.approximation[kind]):
+                print("Top %d %s of %s: overcounted by at most %d, %s." % (
+                    counts, kind, language, error, "exact" if guaranteed else "possibly not the top ones"),
+                    file=sys.stderr)
+
+    # The rows of no line have the number of columns and the type of all the rows.
+    empty = chunkrows(extractor, [])
+    if memmap is None:
+        X_train = np.empty((size, empty.shape[1]), dtype=empty.dtype)
+    else:
+        X_train = np.lib.format.open_memmap(memmap, mode='w+', dtype=empty.dtype, shape=(size, empty.shape[1]))
+    start = 0
+    for chunk in readchunks(input_file, chunksize):
+        rows = chunkrows(extractor, chunk)
+        X_train[start:start + len(rows)] = rows
+        start += len(rows)
+    y = X_train[:, -1].astype(np.int64)
+    if memmap is None and classifier == 'dt' and not raw:
+        X_train = BitMatrix(X_train)
+
+    model = fitmodel(X_train, y, classifier, maxbins if raw else None, None if memmap is None else chunksize)
+    model.extractor = extractor
+    if not raw:
+        model.lookup = LookupTable(model, X_train.shape[1] - 1)
+    savemodel(model, model_output, compact)
+
+
+def trainsharded(shard_files, model_output, raw=False, maxbins=64, ngramwidth=0, compact=False, chunksize=10000,
+                 shards=None):
+    """
+    Train a decision tree on a training dataset split into shards, which are never brought together. The workers
+    holding the shards compute the running statistics of the features and the label counts of the candidate
+    splits of each level of the tree over their shard, and these sums are merged here to fit the features and to
+    grow the tree. The tree is the same as the one train grows on the concatenated shards.
+
+    :param shard_files: The training files of the shards, in the order of the corpus.
+    :param model_output: The output file to store the model.
+    :param raw: Whether to train on the numeric statistics behind the features instead of the boolean features.
+    :param maxbins: The number of quantile bins the tree picks its thresholds from when raw is set.
+    :param ngramwidth: The number of hashed character n-gram columns added to the features, none if 0.
+    :param compact: Whether to store the model in the compact format instead of pickling it.
+    :param chunksize: The number of lines the workers read at a time.
+    :param shards: The workers of the shards, with a map method like LocalShards, a LocalShards of a process per
+        shard file if None.
+    """
+    local = shards is None
+    if local:
+        shards = LocalShards(shard_files, chunksize)
+    try:
+        partials = shards.map('statistics', raw, ngramwidth)
+        extractor = FeatureExtractor(raw=raw, ngramwidth=ngramwidth)
+        for partial in partials:
+            extractor.merge(partial)
+        extractor.finish()
+        sizes = shards.map('features', extractor)
+
+        model = DecisionTree(maxdepth=5, maxbins=maxbins if raw else None)
+        binner = None
+        if raw:
+            # The bin edges are fitted on evenly spaced rows of each shard, which are all the rows of a training
+            # dataset of up to 2 ** 20 rows.
+            share = min(1.0, (1 << 20) / max(sum(sizes), 1))
+            samples = shards.map('sample', share)
+            binner = Binner(maxbins).fit(np.concatenate(samples))
+            shards.map('bin', binner)
+        ranges = np.asarray(shards.map('ranges'))
+        nvalues, nclasses = int(ranges[:, 0].max()) + 1, int(ranges[:, 1].max()) + 1
+
+        def countlevel(split, nnodes):
+            counts = shards.map('counts', model.maxbins, split, nnodes, nvalues, nclasses)
+            return sum(i[0] for i in counts), sum(i[1] for i in counts)
+
+        model.rootnode(model.growlevels(countlevel, nclasses, binner))
+    finally:
+        if local:
+            shards.close()
+
+    model.extractor = extractor
+    if not raw:
+        model.lookup = LookupTable(model, len(extractor.thresholds()) + ngramwidth)
+    savemodel(model, model_output, compact)
+
+
+class LocalShards:
+
+    def __init__(self, shard_files, chunksize=10000):
+        """
+        Local shard workers initialisation, a process is started for each shard file. Another backend, such as one
+        with the workers on other machines, only needs the same map method.
+
+        :param shard_files: The training files of the shards.
+        :param chunksize: The number of lines the workers read at a time.
+        """
+        self.connections = []
+        self.processes = []
+        for shard_file in shard_files:
+            connection, workerconnection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shardworker, args=(workerconnection, shard_file, chunksize),
+                                              daemon=True)
+            process.start()
+            workerconnection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def map(self, command, *args):
+        """
+        A function to run a command of shardworker on all the shards at once.
+
+        :param command: The name of the command.
+        :param args: The arguments of the command.
+        :return: The result of the command on each of the shards, in the order of the shards.
+        """
+        for connection in self.connections:
+            connection.send((command, args))
+        results = [connection.recv() for connection in self.connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def close(self):
+        """
+        A function to stop the workers.
+        """
+        for connection in self.connections:
+            connection.send(('close', ()))
+            connection.close()
+        for process in self.processes:
+            process.join()
+
+
+def shardworker(connection, shard_file, chunksize=10000):
+    """
+    The loop of a shard worker, which holds the feature rows of its shard and the open node of each of them and
+    answers the commands of trainsharded:
+
+    - statistics(raw, ngramwidth): the feature extractor updated on the shard and not finished.
+    - features(extractor): computes the feature rows of the shard with the fitted extractor, returns their number.
+    - sample(share): the features of evenly spaced rows, that share of the rows of the shard.
+    - bin(binner): replaces the features by their bins.
+    - ranges(): the largest feature value and label of the shard, -1 if it is empty.
+    - counts(maxbins, split, nnodes, nvalues, nclasses): moves the rows down the splits of the previous level and
+      returns the label counts of DecisionTree.levelcounts.
+
+    :param connection: The connection to receive the commands on and to send the results to.
+    :param shard_file: The training file of the shard.
+    :param chunksize: The number of lines read at a time.
+    """
+    X, labels, nodeof = None, None, None
+    while True:
+        command, args = connection.recv()
+        if command == 'close':
+            break
+        try:
+            if command == 'statistics':
+                extractor = FeatureExtractor(raw=args[0], ngramwidth=args[1])
+                for chunk in readchunks(shard_file, chunksize):
+                    extractor.update(chunk)
+                result = extractor
+            elif command == 'features':
+                extractor = args[0]
+                # The rows of no line keep the shape and the type of an empty shard.
+                X = np.concatenate([chunkrows(extractor, chunk) for chunk in readchunks(shard_file, chunksize)]
+                                   + [chunkrows(extractor, [])])
+                labels = X[:, -1].astype(np.int64)
+                result = len(X)
+            elif command == 'sample':
+                rows = np.unique(np.linspace(0, len(X) - 1, int(np.ceil(len(X) * args[0]))).astype(np.int64))
+                result = X[rows, :-1]
+            elif command == 'bin':
+                binned = args[0].transform(X[:, :-1])
+                X = np.column_stack((binned, labels.astype(binned.dtype)))
+                result = None
+            elif command == 'ranges':
+                result = (int(X[:, :-1].max()), int(labels.max())) if len(X) else (-1, -1)
+            elif command == 'counts':
+                maxbins, split, nnodes, nvalues, nclasses = args
+                if split is None:
+                    nodeof = np.zeros(len(X), dtype=np.int32)
+                tree = DecisionTree(maxbins=maxbins)
+                result = tree.levelcounts(X, labels, nodeof, split, nnodes, nvalues, nclasses)
+            else:
+                raise ValueError("Unknown shard command %s." % command)
+        except Exception as error:
+            result = error
+        connection.send(result)
+    connection.close()
+
+
+def fitmodel(X_train, y, classifier, maxbins=None, blocksize=None, workers=1):
+    """
+    A function to train the classifier on the feature rows.
+
+    :param X_train: The training dataset, with the labels in the last column, as an array or a BitMatrix.
+    :param y: The target value for the training dataset.
+    :param classifier: The name of the classifier to use.
+    :param maxbins: The number of quantile bins the trees pick their thresholds from, for real valued features.
+    :param blocksize: The number of rows the trees read at a time, for a training dataset on disk. Only the
+        learning types of BLOCKWISE support it.
+    :param workers: The number of processes to grow the trees of a forest with.
+    :return: The trained model.
+    """
+    if blocksize is not None and classifier not in BLOCKWISE:
+        # The other learning types would silently load the whole training dataset into memory.
+        raise ValueError("The learning type %s does not train blockwise." % classifier)
+    if classifier != 'dt' and isinstance(X_train, BitMatrix):
+        # Only the decision tree counts its splits on the packed bits.
+        X_train = X_train.unpack()
+
+    if classifier == 'dt':
+        model = DecisionTree(X_train, y, maxdepth=5, maxbins=maxbins, blocksize=blocksize)
+        dt = model.build_tree(X_train)
+        model.rootnode(dt)
+
     elif classifier == 'ada':
-        ada = Adaboost(X_train, y, 2)
-        #print(type(ada))
+        model = Adaboost(X_train, y, 2, maxbins=maxbins)
+        model.train(X_train)
+
+    elif classifier == 'gb':
+        model = GradientBoosting(X_train, y, maxbins=maxbins or 32)
+        model.train(X_train)
+
+    elif classifier == 'samme':
+        model = Adaboost(X_train, y, 20, weighted=True, maxdepth=2, maxbins=maxbins, blocksize=blocksize)
+        model.train(X_train)
+
+    elif classifier == 'forest':
+        # Each tree sees half of the features, as in the random subspace method.
+        model = RandomForest(X_train, y, 50, maxdepth=5, maxbins=maxbins,
+                             maxfeatures=max(1, (X_train.shape[1] - 1) // 2), workers=workers)
+        model.train(X_train)
+
+    else:
+        raise ValueError("Unknown learning type %s." % classifier)
+
+    return model
+
+
+def savemodel(model, model_output, compact=False):
+    """
+    A function to save the trained model.
+
+    :param model: The trained model.
+    :param model_output: The output file to store the model.
+    :param compact: Whether to store the model in the compact format instead of pickling it.
+    """
+    if compact:
+        savecompact(model, model_output)
+        stale = model_output+'.obj'
+    else:
         file = open(model_output+'.obj','wb')
-        pickle.dump(ada,file)
+        pickle.dump(model,file)
         file.close()
-        ada.train(X_train)
-        #ada.classify(X_train)
-        #a=pickle.load(open('out.obj','rb'))
-        #print(type(a) is Adaboost)
-    # savemodel(model_output)
+        stale = model_output+'.npz'
+    # loadmodel picks the .npz file whenever there is one, so a model of the other format would shadow this one.
+    if os.path.exists(stale):
+        os.remove(stale)
 
 
-def predict(model_name, test_file):
+def savecompact(model, model_output):
     """
-    A function to classify the test dataset.
+    A function to save the trained model in the compact format, a .npz file of the compiled tree arrays, the
+    ensemble weights and the fitted feature statistics only. It is loaded without unpickling anything.
 
-    :param model_name: The file name to load the model from
-    :param test_file: The test file dataset.
+    :param model: The trained model.
+    :param model_output: The output file to store the model, without its extension.
     """
-    # data = testinput(test_file)
-    # loadmodel(model_name)
-    data = testinput(model_name)
-    model = pickle.load(open(test_file+'.obj','rb'))
+    arrays = extractorarrays(model.extractor)
+    arrays.update(version=np.asarray(MODELFORMAT),
+                  lookup=np.asarray(-1 if model.lookup is None else model.lookup.nfeatures))
+    if isinstance(model, Cascade):
+        # The arrays of the two stages are told apart by a prefix ending in a slash, which no other key has.
+        arrays.update(kind=np.asarray('cascade'), margin=np.asarray(model.margin),
+                      innerlookup=np.asarray(-1 if model.model.lookup is None else model.model.lookup.nfeatures))
+        arrays.update(('first/' + key, value) for key, value in modelarrays(model.first).items())
+        arrays.update(('inner/' + key, value) for key, value in modelarrays(model.model).items())
+    else:
+        arrays.update(modelarrays(model))
+    file = open(model_output+'.npz','wb')
+    np.savez(file, **arrays)
+    file.close()
+
+
+def modelarrays(model):
+    """
+    A function to get the compiled arrays of a trained model, to store them without pickle.
+
+    :param model: The trained DecisionTree, Adaboost or GradientBoosting model.
+    :return: A dictionary of the arrays, with the kind of the model.
+    """
+    if isinstance(model, DecisionTree):
+        return dict(kind=np.asarray('dt'), maxbins=np.asarray(model.maxbins or 0), feature=model.feature,
+                    value=model.value, left=model.left, right=model.right, leafclass=model.leafclass,
+                    leafcounts=model.leafcounts)
+    elif isinstance(model, Adaboost):
+        return dict(kind=np.asarray('ada'), maxbins=np.asarray(model.maxbins or 0), roots=model.roots,
+                    feature=model.feature, value=model.value, left=model.left, right=model.right,
+                    leafclass=model.leafclass, modelweight=np.asarray(model.modelweight, dtype=np.float64))
+    elif isinstance(model, GradientBoosting):
+        return dict(kind=np.asarray('gb'), maxbins=np.asarray(model.maxbins), roots=model.roots,
+                    feature=model.feature, threshold=model.threshold, left=model.left, right=model.right,
+                    value=model.value, baseline=np.asarray(model.baseline),
+                    edges=np.concatenate(model.binner.edges),
+                    edgecounts=np.asarray([len(i) for i in model.binner.edges]))
+    raise ValueError("Unsupported model type %s." % type(model).__name__)
+
+
+def extractorarrays(extractor):
+    """
+    A function to get the fitted statistics of a feature extractor as arrays, to store them without pickle.
 
-    feature1 = np.asarray(lengthofwords(english, dutch, data))
+    :param extractor: The fitted feature extractor.
+    :return: A dictionary of the arrays.
+    """
+    return {
+        'raw': np.asarray(extractor.raw),
+        'ngramwidth': np.asarray(extractor.ngramwidth),
+        'thresholds': np.asarray(extractor.thresholds(), dtype=np.float64),
+        'englishletters': np.asarray(extractor.englishletters, dtype=str),
+        'dutchletters': np.asarray(extractor.dutchletters, dtype=str),
+        'englishcommon': np.asarray(extractor.englishcommon, dtype=str),
+        'dutchcommon': np.asarray(extractor.dutchcommon, dtype=str),
+        # The largest overcount and whether the top items are exact, of the letters and words of each language.
+        'approximation': np.asarray([] if extractor.approximation is None else
+                                    [extractor.approximation['letters'], extractor.approximation['words']],
+                                    dtype=np.float64),
+    }
+
+
+def loadextractor(arrays):
+    """
+    A function to rebuild a fitted feature extractor from the arrays of extractorarrays.
 
-    feature2 = np.asarray(freqoflettersinsentence(english, dutch, data))
+    :param arrays: The arrays, as a dictionary or a loaded .npz file.
+    :return: The fitted feature extractor.
+    """
+    extractor = FeatureExtractor(raw=bool(arrays['raw']), ngramwidth=int(arrays['ngramwidth']))
+    (extractor.lengththreshold, _, _, _, _, extractor.uniquethreshold, extractor.letterthreshold,
+     extractor.bigramthreshold, extractor.trigramthreshold, extractor.repeatingthreshold) = \
+        arrays['thresholds'].tolist()
+    extractor.englishletters = arrays['englishletters'].tolist()
+    extractor.dutchletters = arrays['dutchletters'].tolist()
+    extractor.englishset = set(extractor.englishletters) - set(extractor.dutchletters)
+    extractor.dutchset = set(extractor.dutchletters) - set(extractor.englishletters)
+    extractor.englishcommon = arrays['englishcommon'].tolist()
+    extractor.dutchcommon = arrays['dutchcommon'].tolist()
+    if 'approximation' in arrays and arrays['approximation'].size > 0:
+        letters, words = arrays['approximation'].tolist()
+        extractor.approximation = {
+            'letters': [[int(error), bool(guaranteed)] for error, guaranteed in letters],
+            'words': [[int(error), bool(guaranteed)] for error, guaranteed in words],
+        }
+    return extractor
+
+
+def loadcompact(model_name):
+    """
+    A function to load a model saved in the compact format.
 
-    feature3 = np.asarray(uncommontopletters(english, dutch, data))
+    :param model_name: The file the model was stored to, without its extension.
+    :return: The trained model, which classifies with predict_batch only as the tree nodes are not stored.
+    """
+    with np.load(model_name+'.npz', allow_pickle=False) as arrays:
+        if int(arrays['version']) != MODELFORMAT:
+            raise ValueError("Unsupported model format version %d." % int(arrays['version']))
+
+        extractor = loadextractor(arrays)
+        if str(arrays['kind']) == 'cascade':
+            first = arraysmodel({key[6:]: arrays[key] for key in arrays.files if key.startswith('first/')})
+            inner = arraysmodel({key[6:]: arrays[key] for key in arrays.files if key.startswith('inner/')})
+            inner.extractor = extractor
+            if int(arrays['innerlookup']) >= 0:
+                inner.lookup = LookupTable(inner, int(arrays['innerlookup']))
+            model = Cascade(first, inner, float(arrays['margin']))
+        else:
+            model = arraysmodel(arrays)
+        lookup = int(arrays['lookup'])
+
+    model.extractor = extractor
+    if lookup >= 0:
+        model.lookup = LookupTable(model, lookup)
+    return model
+
+
+def arraysmodel(arrays):
+    """
+    A function to rebuild a trained model from the arrays of modelarrays.
 
-    feature4 = np.asarray(worduniqueness(english, dutch, data))
+    :param arrays: The arrays, as a dictionary or a loaded .npz file.
+    :return: The trained model.
+    """
+    kind = str(arrays['kind'])
+    if kind == 'dt':
+        model = DecisionTree(maxbins=int(arrays['maxbins']) or None)
+        model.leafcounts = arrays['leafcounts']
+    elif kind == 'ada':
+        model = Adaboost(None, None, len(arrays['modelweight']), maxbins=int(arrays['maxbins']) or None)
+        model.roots = arrays['roots']
+        model.modelweight = arrays['modelweight'].tolist()
+    elif kind == 'gb':
+        model = GradientBoosting(None, None, maxbins=int(arrays['maxbins']))
+        model.roots = arrays['roots']
+        model.threshold = arrays['threshold']
+        model.baseline = float(arrays['baseline'])
+        model.binner = Binner(model.maxbins)
+        model.binner.edges = np.split(arrays['edges'], np.cumsum(arrays['edgecounts'])[:-1])
+    else:
+        raise ValueError("Unknown model kind %s." % kind)
+    model.feature = arrays['feature']
+    model.left = arrays['left']
+    model.right = arrays['right']
+    model.value = arrays['value']
+    if kind != 'gb':
+        model.leafclass = arrays['leafclass']
+    return model
+
+
+def loadmodel(model_name):
+    """
+    A function to load a trained model, from its compact .npz file if there is one and else from its pickle.
 
-    feature5 = np.asarray(tfidf(english, dutch, data))
+    :param model_name: The file the model was stored to, without its extension.
+    :return: The trained model.
+    """
+    if os.path.exists(model_name+'.npz'):
+        return loadcompact(model_name)
+    file = open(model_name+'.obj','rb')
+    model = pickle.load(file)
+    file.close()
+    return model
 
-    feature6 = np.asarray(uniquewordsinsentence(english, dutch, data))
 
-    feature7 = np.asarray(uniquelettersinasentence(english, dutch, data))
+def modelcolumns(model):
+    """
+    A function to get the feature columns a trained model tests at its nodes.
 
-    feature8 = np.asarray(bigram(english, dutch, data))
+    :param model: The trained model.
+    :return: The sorted columns.
+    """
+    return np.unique(model.feature[model.feature >= 0]).tolist()
 
-    feature9 = np.asarray(trigram(english, dutch, data))
 
-    feature10 = np.asarray(wordswithrepeatingletters(english, dutch, data))
+def classifysentences(model, data, workers=1, lazy=False):
+    """
+    A function to classify sentences with a trained model. Only the features the model tests are computed, and
+    with lazy set the features of each sentence are computed one at a time, only when a node on the path of the
+    sentence tests them. A cascade computes the features of its model only for the sentences its first stage leaves.
+
+    :param model: The trained model.
+    :param data: The sentences.
+    :param workers: The number of processes to compute the features with.
+    :param lazy: Whether to classify the sentences one at a time with lazily computed features, for a decision
+        tree or an ensemble of them. It is faster for a few sentences at a time, and slower for large batches.
+    :return: The predicted label of each sentence, 1 for english and 0 for dutch.
+    """
+    if isinstance(model, Cascade):
+        labels, confident = model.firststage(model.extractor.transform(data, workers, modelcolumns(model.first)))
+        rest = np.flatnonzero(~confident)
+        if len(rest):
+            labels[rest] = classifysentences(model.model, [data[i] for i in rest], workers, lazy)
+        return labels
+    if lazy and isinstance(model, (DecisionTree, Adaboost)):
+        return np.asarray([model.predict_lazy(model.extractor.lazyfeatures(i)) for i in data], dtype=np.int64)
+    X_train = model.extractor.transform(data, workers, modelcolumns(model))
+    if model.lookup is not None:
+        return model.lookup.predict_batch(X_train)
+    return model.predict_batch(X_train)
+
+
+def predict(model_name, test_file, workers=1, lazy=False):
+    """
+    A function to classify the test dataset.
 
-    X_train = np.column_stack(
-        (feature1, feature2, feature3, feature4, feature5, feature6, feature7, feature8, feature9, feature10))
+    :param model_name: The file name to load the model from
+    :param test_file: The test file dataset.
+    :param workers: The number of processes to compute the features with.
+    :param lazy: Whether to compute the features of each sentence only when the tree tests them.
+    """
+    # data = testinput(test_file)
+    data = testinput(model_name)
+    model = loadmodel(test_file)
 
+    answers = classifysentences(model, data, workers, lazy)
+    print('\n'.join("en" if i == 1 else "nl" for i in answers))
+    if isinstance(model, Cascade):
+        print("Early exits: %.1f%%" % (100 * model.exitrate()), file=sys.stderr)
 
-    if type(model) is Adaboost:
-        ada.classify(X_train)
-    elif type(model) is DecisionTree:
-        for i in X_train:
-            # print(tree.classify(i,dt))
-            answer = model.classify(i, model.dt)
-            if 0 in answer:
-                print("nl")
-            elif 1 in answer:
-                print("en")
 
+def predictstream(model_name, test_file=None, batchsize=1000, output=None, lineids=False, lazy=False):
+    """
+    A function to classify a stream of sentences in micro batches. The lines are read a batch at a time, and the
+    answers of each batch are written to a buffered output in a single write, so memory stays constant and each
+    batch takes about the same time.
+
+    :param model_name: The file the model was stored to, without its extension.
+    :param test_file: The file to read the sentences from, the standard input if None.
+    :param batchsize: The number of lines classified at a time.
+    :param output: The binary stream to write the answers to, the standard output if None.
+    :param lineids: Whether to prefix each answer with the number of its line.
+    :param lazy: Whether to compute the features of each sentence only when the tree tests them.
+    :return: The number of lines classified.
+    """
+    model = loadmodel(model_name)
+    count = 0
+    with open(test_file, encoding="utf8") if test_file is not None else contextlib.nullcontext(sys.stdin) as source:
+        writer = io.BufferedWriter(sys.stdout.buffer if output is None else output, buffer_size=1 << 16)
+        try:
+            batch = []
+            for line in itertools.chain(source, [None]):
+                if line is not None:
+                    batch.append(line.rstrip('\r\n'))
+                if batch and (line is None or len(batch) == batchsize):
+                    answers = classifysentences(model, batch, lazy=lazy)
+                    if lineids:
+                        text = ''.join('%d\t%s\n' % (count + i, "en" if j == 1 else "nl")
+                                       for i, j in enumerate(answers))
+                    else:
+                        text = ''.join("en\n" if j == 1 else "nl\n" for j in answers)
+                    writer.write(text.encode())
+                    writer.flush()
+                    count += len(batch)
+                    batch = []
+        finally:
+            # The writer is detached even when a batch fails, or closing it would close the output stream too.
+            try:
+                writer.flush()
+            finally:
+                writer.detach()
+    if isinstance(model, Cascade):
+        print("Early exits: %.1f%%" % (100 * model.exitrate()), file=sys.stderr)
+    return count